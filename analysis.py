@@ -0,0 +1,223 @@
+import numpy as np
+from scipy.signal import sosfilt
+
+import dynamics
+
+# Single-pass analysis: loudness (integrated / short-term / momentary / LRA),
+# true peak, phase correlation and the mono-sum loudness drop are all fed from
+# the same blocks with running accumulators, so a master is read exactly once
+# and the report is reused by the engine, the GUI and the streaming renderer.
+
+ANALYSIS_BLOCK_FRAMES = 262144
+
+
+# --- Loudness ---
+def k_weighting_sos(sample_rate):
+    """BS.1770 K-weighting (high shelf + RLB high-pass) as a second-order-section cascade."""
+    # Stage 1: high shelf, +4 dB at 1500 Hz
+    A = 10 ** (4.0 / 40.0)
+    w0 = 2 * np.pi * 1500.0 / sample_rate
+    alpha = np.sin(w0) / (2 * (1 / np.sqrt(2)))
+    cos_w0 = np.cos(w0)
+    shelf_b = [A * ((A + 1) + (A - 1) * cos_w0 + 2 * np.sqrt(A) * alpha),
+               -2 * A * ((A - 1) + (A + 1) * cos_w0),
+               A * ((A + 1) + (A - 1) * cos_w0 - 2 * np.sqrt(A) * alpha)]
+    shelf_a = [(A + 1) - (A - 1) * cos_w0 + 2 * np.sqrt(A) * alpha,
+               2 * ((A - 1) - (A + 1) * cos_w0),
+               (A + 1) - (A - 1) * cos_w0 - 2 * np.sqrt(A) * alpha]
+
+    # Stage 2: high-pass at 38 Hz
+    w0 = 2 * np.pi * 38.0 / sample_rate
+    alpha = np.sin(w0) / (2 * 0.5)
+    cos_w0 = np.cos(w0)
+    hp_b = [(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2]
+    hp_a = [1 + alpha, -2 * cos_w0, 1 - alpha]
+
+    sos = np.array([np.concatenate([shelf_b, shelf_a]) / shelf_a[0],
+                    np.concatenate([hp_b, hp_a]) / hp_a[0]])
+    return sos
+
+
+class LoudnessMeter:
+    """
+    Integrated loudness (BS.1770-4) fed block by block. Only the per-channel
+    energy of every 100 ms step is kept, so memory grows by a few floats per
+    second of audio instead of holding the signal.
+    """
+
+    def __init__(self, sample_rate, channels, weights=None):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.step = int(round(0.1 * sample_rate))
+        self.sos = k_weighting_sos(sample_rate)
+        self.zi = np.zeros((self.sos.shape[0], 2, channels))
+        if weights is None:
+            weights = [1.0, 1.0, 1.0, 1.41, 1.41][:channels] + [1.0] * max(0, channels - 5)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self._partial = np.zeros(channels)
+        self._partial_len = 0
+        self._steps = []
+
+    def add(self, block):
+        weighted, self.zi = sosfilt(self.sos, block, axis=0, zi=self.zi)
+        squared = np.square(weighted)
+
+        # Top up the 100 ms step left open by the previous block
+        pos = 0
+        if self._partial_len:
+            take = min(self.step - self._partial_len, len(squared))
+            self._partial += squared[:take].sum(axis=0)
+            self._partial_len += take
+            pos = take
+            if self._partial_len == self.step:
+                self._steps.append(self._partial[None, :].copy())
+                self._partial[:] = 0
+                self._partial_len = 0
+
+        full = (len(squared) - pos) // self.step
+        if full:
+            end = pos + full * self.step
+            self._steps.append(squared[pos:end].reshape(full, self.step, self.channels).sum(axis=1))
+            pos = end
+
+        if pos < len(squared):
+            self._partial += squared[pos:].sum(axis=0)
+            self._partial_len += len(squared) - pos
+
+    def block_energies(self, window_steps=4):
+        """
+        Mean square per channel of every window_steps x 100 ms window, one per
+        100 ms: 4 steps are the 400 ms gating/momentary blocks, 30 the 3 s
+        short-term windows.
+        """
+        if not self._steps:
+            return np.zeros((0, self.channels))
+        steps = np.concatenate(self._steps)
+        if len(steps) < window_steps:
+            return np.zeros((0, self.channels))
+        sums = np.cumsum(np.vstack([np.zeros((1, self.channels)), steps]), axis=0)
+        return (sums[window_steps:] - sums[:-window_steps]) / (window_steps * self.step)
+
+    def window_loudness(self, window_steps=4):
+        with np.errstate(divide="ignore"):
+            return -0.691 + 10 * np.log10(self.block_energies(window_steps) @ self.weights)
+
+    def integrated_loudness(self):
+        z = self.block_energies()
+        if not len(z):
+            return -np.inf
+
+        with np.errstate(divide="ignore"):
+            block_lufs = -0.691 + 10 * np.log10(z @ self.weights)
+
+        # Absolute gate at -70 LUFS, then relative gate 10 LU below
+        gated = block_lufs > -70.0
+        if not gated.any():
+            return -np.inf
+        relative = -0.691 + 10 * np.log10(z[gated].mean(axis=0) @ self.weights) - 10.0
+        gated &= block_lufs > relative
+        if not gated.any():
+            return -np.inf
+        return -0.691 + 10 * np.log10(z[gated].mean(axis=0) @ self.weights)
+
+    def loudness_range(self):
+        """EBU Tech 3342 LRA from the 3 s short-term values."""
+        short_term = self.window_loudness(30)
+        short_term = short_term[short_term > -70.0]
+        if not len(short_term):
+            return 0.0
+        relative = 10 * np.log10(np.mean(10 ** (short_term / 10.0))) - 20.0
+        short_term = short_term[short_term > relative]
+        low, high = np.percentile(short_term, [10, 95])
+        return float(high - low)
+
+
+def integrated_loudness(buffer, sample_rate, block_frames=ANALYSIS_BLOCK_FRAMES):
+    meter = LoudnessMeter(sample_rate, buffer.shape[1])
+    for pos in range(0, len(buffer), block_frames):
+        meter.add(buffer[pos:pos + block_frames])
+    return meter.integrated_loudness()
+
+
+# --- Full Analysis ---
+class AnalysisAccumulator:
+    """Everything the report needs, fed one block at a time in a single pass."""
+
+    def __init__(self, sample_rate, channels, oversample=4):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.oversample = oversample
+        self.frames = 0
+
+        self.meter = LoudnessMeter(sample_rate, channels)
+        # The mono sum as heard on both speakers, so a track with L == R shows
+        # no drop and only real cancellation between L and R counts
+        self.mono_meter = LoudnessMeter(sample_rate, 1, weights=[float(min(channels, 2))])
+
+        self._sample_peak = 0.0
+        self._true_peak = 0.0
+        # Tail of the previous block, so the oversampler sees across block edges
+        self._history = np.zeros((dynamics.TRUE_PEAK_MARGIN, channels), dtype=np.float32)
+
+        # Running sums for the L/R Pearson correlation
+        self._sums = np.zeros(5)  # sum L, sum R, sum L*L, sum R*R, sum L*R
+
+    def add(self, block):
+        if not len(block):
+            return
+        self.frames += len(block)
+        self.meter.add(block)
+
+        # Mono sum, same (L + R) / 2 downmix as AudioSegment.set_channels(1)
+        self.mono_meter.add(block.mean(axis=1, keepdims=True))
+
+        self._sample_peak = max(self._sample_peak, float(np.max(np.abs(block))))
+        ext = np.concatenate([self._history, block])
+        self._true_peak = max(self._true_peak, float(dynamics.true_peak_envelope(ext, self.oversample).max()))
+        self._history = ext[-dynamics.TRUE_PEAK_MARGIN:]
+
+        if self.channels >= 2:
+            left = block[:, 0].astype(np.float64)
+            right = block[:, 1].astype(np.float64)
+            self._sums += [left.sum(), right.sum(), left @ left, right @ right, left @ right]
+
+    def phase_correlation(self):
+        if self.channels < 2 or not self.frames:
+            return 1.0
+        n = self.frames
+        sum_l, sum_r, sum_ll, sum_rr, sum_lr = self._sums
+        var_l = n * sum_ll - sum_l * sum_l
+        var_r = n * sum_rr - sum_r * sum_r
+        if var_l <= 0 or var_r <= 0:
+            # Silence or a constant channel: nothing to cancel in mono
+            return 1.0
+        return float((n * sum_lr - sum_l * sum_r) / np.sqrt(var_l * var_r))
+
+    def report(self):
+        integrated = self.meter.integrated_loudness()
+        mono = self.mono_meter.integrated_loudness()
+        momentary = self.meter.window_loudness(4)
+        short_term = self.meter.window_loudness(30)
+
+        def db(value):
+            return float(20 * np.log10(value)) if value > 0 else -np.inf
+
+        return {
+            "duration_sec": self.frames / self.sample_rate,
+            "integrated_lufs": float(integrated),
+            "momentary_max_lufs": float(momentary.max()) if len(momentary) else -np.inf,
+            "short_term_max_lufs": float(short_term.max()) if len(short_term) else -np.inf,
+            "loudness_range_lu": self.meter.loudness_range(),
+            "sample_peak_dbfs": db(self._sample_peak),
+            "true_peak_dbtp": db(self._true_peak),
+            "phase_correlation": self.phase_correlation(),
+            "mono_lufs": float(mono),
+            "mono_drop_db": float(integrated - mono) if np.isfinite(integrated) and np.isfinite(mono) else 0.0,
+        }
+
+
+def analyze(buffer, sample_rate, block_frames=ANALYSIS_BLOCK_FRAMES):
+    accumulator = AnalysisAccumulator(sample_rate, buffer.shape[1])
+    for pos in range(0, len(buffer), block_frames):
+        accumulator.add(buffer[pos:pos + block_frames])
+    return accumulator.report()
@@ -0,0 +1,192 @@
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+
+import cache
+
+# Parallel batch runner: every file is mastered in its own worker process, so a
+# crash or a hung decode only takes out that one job. Finished jobs are appended
+# to a JSON-lines manifest as they complete, and a re-run skips anything the
+# manifest already has, so an interrupted batch picks up where it stopped.
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac")
+MANIFEST_NAME = "batch_manifest.jsonl"
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return {"input_size": stat.st_size, "input_mtime_ns": stat.st_mtime_ns}
+
+
+# --- Manifest ---
+def load_manifest(manifest_path):
+    """Returns the finished entries of a manifest, keyed by input path."""
+    done = {}
+    if not os.path.exists(manifest_path):
+        return done
+
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn last line from a killed run, that job just gets redone
+                continue
+            if entry.get("status") == "ok":
+                done[entry["input"]] = entry
+    return done
+
+
+def _is_finished(entry, input_path, job_params_hash):
+    if entry is None or entry.get("params_hash") != job_params_hash:
+        return False
+    if _file_key(input_path) != {k: entry.get(k) for k in ("input_size", "input_mtime_ns")}:
+        return False
+    output = entry.get("output")
+    return output is not None and os.path.exists(output) and os.path.getsize(output) == entry.get("output_size")
+
+
+def _append_manifest(manifest_path, entry):
+    with open(manifest_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# --- Worker ---
+def _render_job(job, conn):
+    import main
+
+    started = time.perf_counter()
+    try:
+        input_sha = main.generate_file_hash(job["input"])
+        info = main.snip_audio(job["input"], job["start"], job["end"], job["output"], **job["params"])
+        conn.send({
+            "input": job["input"],
+            "status": "ok",
+            "input_sha256": input_sha,
+            "sha256": info["sha256"],
+            "duration_sec": info["duration_sec"],
+            "wall_sec": time.perf_counter() - started,
+            "stage_sec": {s["stage"]: s["wall_sec"] for s in info["timing"]["stages"]},
+        })
+    except Exception as e:
+        conn.send({
+            "input": job["input"],
+            "status": "error",
+            "error": f"{type(e).__name__}: {e}",
+            "wall_sec": time.perf_counter() - started,
+        })
+    finally:
+        conn.close()
+
+
+# --- Runner ---
+def run_batch(input_folder, output_folder, start, end, workers=None, timeout=None, manifest_path=None, **params):
+    """
+    Masters every audio file in input_folder with up to `workers` processes
+    (default: one per core). `timeout` is in seconds per file; a job that runs
+    over is killed and recorded as timed out. Extra keyword arguments are
+    passed on to snip_audio. Returns the aggregate report as a dict.
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    workers = workers or os.cpu_count() or 1
+    manifest_path = manifest_path or os.path.join(output_folder, MANIFEST_NAME)
+    finished = load_manifest(manifest_path)
+
+    # --- Build Job List ---
+    pending = []
+    skipped = 0
+    for filename in sorted(os.listdir(input_folder)):
+        if not filename.endswith(AUDIO_EXTENSIONS):
+            continue
+        input_path = os.path.join(input_folder, filename)
+        job_params = dict(params, export_format=filename.split('.')[-1])
+        job_params_hash = cache.canonical_hash(dict(job_params, start=start, end=end))
+
+        if _is_finished(finished.get(input_path), input_path, job_params_hash):
+            skipped += 1
+            continue
+
+        pending.append({
+            "input": input_path,
+            "output": os.path.join(output_folder, f"mastered_{filename}"),
+            "start": start,
+            "end": end,
+            "params": job_params,
+            "params_hash": job_params_hash,
+        })
+
+    print(f"Batch: {len(pending)} to render, {skipped} already done, {workers} workers")
+
+    # --- Schedule ---
+    # Each job reports through its own pipe, so killing one that timed out
+    # can't leave a shared channel locked or half-written for the rest
+    ctx = multiprocessing.get_context()
+    running = {}
+    report = {"ok": 0, "error": 0, "timeout": 0, "skipped": skipped, "audio_sec": 0.0}
+    batch_started = time.perf_counter()
+
+    def record(job, outcome):
+        entry = {
+            "input": job["input"],
+            "output": job["output"],
+            "params": dict(job["params"], start=job["start"], end=job["end"]),
+            "params_hash": job["params_hash"],
+            **_file_key(job["input"]),
+            **outcome,
+        }
+        if outcome["status"] == "ok":
+            entry["output_size"] = os.path.getsize(job["output"])
+            report["audio_sec"] += outcome["duration_sec"]
+        report[outcome["status"]] += 1
+        _append_manifest(manifest_path, entry)
+        print(f"Batch [{outcome['status']}] {os.path.basename(job['input'])} ({outcome['wall_sec']:.1f}s)")
+
+    while pending or running:
+        while pending and len(running) < workers:
+            job = pending.pop(0)
+            reader, writer = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_render_job, args=(job, writer), daemon=True)
+            proc.start()
+            # Our copy of the write end must go, or the reader never sees EOF
+            writer.close()
+            running[job["input"]] = (job, proc, time.perf_counter(), reader)
+
+        ready = multiprocessing.connection.wait([entry[3] for entry in running.values()], timeout=0.5)
+        now = time.perf_counter()
+        for key, (job, proc, job_started, reader) in list(running.items()):
+            if reader in ready:
+                try:
+                    outcome = reader.recv()
+                except (EOFError, OSError):
+                    outcome = None
+                reader.close()
+                proc.join()
+                if outcome is None:
+                    # Died without reporting back (segfault, OOM kill)
+                    outcome = {"status": "error", "error": f"worker exited with code {proc.exitcode}",
+                               "wall_sec": now - job_started}
+                del running[key]
+                record(job, outcome)
+            elif timeout is not None and now - job_started > timeout:
+                proc.terminate()
+                proc.join()
+                reader.close()
+                del running[key]
+                record(job, {"status": "timeout", "error": f"exceeded {timeout}s", "wall_sec": now - job_started})
+
+    wall = time.perf_counter() - batch_started
+    report["wall_sec"] = wall
+    report["realtime_factor"] = report["audio_sec"] / wall if wall > 0 else 0.0
+    print(f"Batch done: {report['ok']} ok, {report['error']} failed, {report['timeout']} timed out, "
+          f"{report['skipped']} skipped | {report['audio_sec']:.1f} audio-s in {wall:.1f} wall-s "
+          f"({report['realtime_factor']:.1f} audio-s per wall-s)")
+    return report
@@ -0,0 +1,280 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+import numpy as np
+from pydub import AudioSegment
+
+import dynamics
+import engine
+
+# Performance checks for the DSP stages. Run: python benchmark.py
+#
+# Every case renders a seeded synthetic signal to a WAV file, loads it the way
+# the tool does and measures the function on it: throughput as a realtime
+# factor (audio seconds per wall second, best of a few runs) and peak memory
+# (tracemalloc peak of a separate run, so tracing never skews the timings).
+# Results are written as JSON; given a baseline, cases that got slower or
+# hungrier than the threshold are flagged and the exit status is 1.
+#
+#   python benchmark.py                       quick suite, compare to baseline
+#   python benchmark.py --suite full          formats matrix + 10 s .. 60 min sweep
+#   python benchmark.py --save-baseline       record the current numbers
+#   python benchmark.py --only snip_audio,apply_dither
+#   python benchmark.py --only clipper           soft clipper per oversampling ratio
+
+DEFAULT_BASELINE = "benchmark_baseline.json"
+DEFAULT_THRESHOLD = 0.20
+
+# (channels, sample_rate, bits) at 10 s, then a duration sweep at 48k stereo 16-bit
+SUITES = {
+    "quick": {
+        "formats": [(2, 48000, 16), (1, 44100, 16), (2, 96000, 24), (2, 48000, 32)],
+        "durations": [10, 60],
+    },
+    "full": {
+        "formats": [(channels, rate, bits) for channels in (1, 2)
+                    for rate in (44100, 48000, 96000) for bits in (16, 24, 32)],
+        "durations": [10, 60, 600, 3600],
+    },
+}
+
+
+# --- Signals ---
+def synthetic_signal(seconds, sample_rate=48000, channels=2, seed=0):
+    """Noise bed with a loud transient every second, float32 (frames, channels)."""
+    rng = np.random.default_rng(seed)
+    frames = int(seconds * sample_rate)
+    signal = (rng.standard_normal((frames, channels)) * 0.2).astype(np.float32)
+    signal[::sample_rate] *= 8.0
+    return signal
+
+
+def write_test_wav(path, seconds, sample_rate=48000, channels=2, bits=16, seed=0):
+    """Writes synthetic_signal as a PCM WAV of the given bit depth (16, 24 or 32)."""
+    signal = synthetic_signal(seconds, sample_rate, channels, seed)
+    np.clip(signal, -1.0, 1.0, out=signal)
+    if bits == 24:
+        # Top three bytes of each little-endian int32 sample
+        pcm = engine.quantize(signal, 4).view(np.uint8).reshape(-1, 4)[:, 1:].tobytes()
+    else:
+        pcm = engine.quantize(signal, bits // 8).tobytes()
+
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(bits // 8)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return path
+
+
+# --- Cases ---
+# Each case takes (wav_path, seconds, workdir), loads what it needs and returns
+# a zero-argument callable that runs the function once.
+def _segment_case(call):
+    def prepare(path, seconds, workdir):
+        segment = AudioSegment.from_file(path)
+        return lambda: call(segment, seconds)
+    return prepare
+
+
+def _snip_case(path, seconds, workdir):
+    import main
+
+    output_file = os.path.join(workdir, "bench_master.wav")
+    return lambda: main.snip_audio(path, 0, seconds, output_file, visualize="fast")
+
+
+def _cases():
+    import main
+
+    return {
+        "find_zero_crossing": _segment_case(lambda seg, seconds: main.find_zero_crossing(seg, seconds * 500)),
+        "apply_til_eq": _segment_case(lambda seg, seconds: main.apply_til_eq(seg, tilt_amount=1.0)),
+        "apply_ms_tonal_balance": _segment_case(lambda seg, seconds: main.apply_ms_tonal_balance(seg, side_gain_db=0.7)),
+        "apply_safe_width": _segment_case(lambda seg, seconds: main.apply_safe_width(seg, width_factor=1.2)),
+        "apply_soft_clip": _segment_case(lambda seg, seconds: main.apply_soft_clip(seg)),
+        "measure_loudness": _segment_case(lambda seg, seconds: main.measure_loudness(seg)),
+        "apply_dither": _segment_case(lambda seg, seconds: main.apply_dither(seg)),
+        "snip_audio": _snip_case,
+    }
+
+
+def case_id(name, channels, sample_rate, bits, seconds):
+    return f"{name}/{channels}ch-{sample_rate}Hz-{bits}bit-{seconds}s"
+
+
+# --- Measurement ---
+def _quiet(run):
+    # The chain narrates every stage; keep the benchmark table readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        run()
+
+
+def measure(run, seconds, repeats):
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        _quiet(run)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        _quiet(run)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "wall_sec": round(best, 6),
+        "realtime": round(seconds / best, 2) if best > 0 else None,
+        "peak_mb": round(peak / 2**20, 2),
+    }
+
+
+def run_suite(suite="quick", only=None, workdir=None):
+    config = SUITES[suite]
+    cases = _cases()
+    names = [name for name in cases if only is None or name in only]
+    signals = [(fmt, 10) for fmt in config["formats"]]
+    signals += [((2, 48000, 16), seconds) for seconds in config["durations"] if ((2, 48000, 16), seconds) not in signals]
+
+    own_dir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="mastering_bench_")
+    results = {}
+    try:
+        for (channels, sample_rate, bits), seconds in signals:
+            path = os.path.join(workdir, f"signal_{channels}ch_{sample_rate}_{bits}_{seconds}.wav")
+            write_test_wav(path, seconds, sample_rate, channels, bits)
+            repeats = 3 if seconds <= 60 else 1
+
+            for name in names:
+                key = case_id(name, channels, sample_rate, bits, seconds)
+                run = cases[name](path, seconds, workdir)
+                results[key] = measure(run, seconds, repeats)
+                r = results[key]
+                print(f"{key:<60} {r['realtime']:>9.1f}x realtime {r['peak_mb']:>9.1f} MB peak")
+                del run
+            os.remove(path)
+    finally:
+        if own_dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "suite": suite,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+# --- Baselines ---
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_results(results, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Returns the regressions: cases more than `threshold` slower or hungrier than the baseline."""
+    regressions = []
+    for key, current in results["results"].items():
+        previous = baseline["results"].get(key)
+        if previous is None:
+            continue
+        if previous["realtime"] and current["realtime"] < previous["realtime"] * (1.0 - threshold):
+            regressions.append({"case": key, "metric": "realtime",
+                                "baseline": previous["realtime"], "current": current["realtime"]})
+        if previous["peak_mb"] and current["peak_mb"] > previous["peak_mb"] * (1.0 + threshold):
+            regressions.append({"case": key, "metric": "peak_mb",
+                                "baseline": previous["peak_mb"], "current": current["peak_mb"]})
+    return regressions
+
+
+# --- Limiter Target ---
+def bench_limiter(seconds=60, sample_rate=48000, min_realtime=50.0):
+    signal = synthetic_signal(seconds, sample_rate)
+
+    started = time.perf_counter()
+    dynamics.apply_true_peak_limiter(signal, sample_rate, ceiling=-1.0)
+    elapsed = time.perf_counter() - started
+
+    realtime = seconds / elapsed
+    passed = realtime >= min_realtime
+    print(f"True-peak limiter: {seconds}s stereo @ {sample_rate}Hz in {elapsed:.2f}s "
+          f"-> {realtime:.0f}x realtime ({'PASS' if passed else 'FAIL'}, target {min_realtime:.0f}x)")
+    return passed
+
+
+def bench_clipper(seconds=60, sample_rate=48000, min_realtime=50.0):
+    """Realtime factor of the soft clipper per oversampling ratio; the default (4x) must meet min_realtime."""
+    realtime = {}
+    for ratio in dynamics.CLIP_OVERSAMPLE_RATIOS:
+        signal = synthetic_signal(seconds, sample_rate)
+        started = time.perf_counter()
+        dynamics.apply_soft_clip(signal, oversample=ratio)
+        realtime[ratio] = seconds / (time.perf_counter() - started)
+        print(f"Soft clipper {ratio}x: {seconds}s stereo @ {sample_rate}Hz -> {realtime[ratio]:.0f}x realtime")
+
+    passed = realtime[4] >= min_realtime
+    print(f"Soft clipper default (4x): {'PASS' if passed else 'FAIL'}, target {min_realtime:.0f}x")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the mastering DSP functions.")
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick")
+    parser.add_argument("--only", help="comma-separated function names")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown / memory growth as a fraction (default 0.2)")
+    args = parser.parse_args()
+
+    only = set(args.only.split(",")) if args.only else None
+    ok = True
+    if only is None or only & set(_cases()):
+        results = run_suite(args.suite, only=only)
+        if args.output:
+            save_results(results, args.output)
+
+        if args.save_baseline:
+            print(f"Baseline saved: {save_results(results, args.baseline)}")
+        else:
+            baseline = load_baseline(args.baseline)
+            if baseline is None:
+                print(f"No baseline at {args.baseline}; run with --save-baseline to record one.")
+            else:
+                regressions = compare(results, baseline, args.threshold)
+                for r in regressions:
+                    print(f"REGRESSION {r['case']}: {r['metric']} {r['baseline']} -> {r['current']}")
+                print(f"{len(regressions)} regression(s) against {args.baseline} (threshold {args.threshold:.0%})")
+                ok = not regressions
+
+    if only is None or "limiter" in only:
+        ok = bench_limiter() and ok
+    if only is None or "clipper" in only:
+        ok = bench_clipper() and ok
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,307 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# Content-addressed render cache. Entries are keyed by the input file's SHA-256
+# plus a canonical hash of the parameters that shaped them, so a key can never
+# point at stale audio. Two kinds of entries live here:
+#   render - the exported master (and its analysis PNG) for a full parameter set
+#   stage  - the decoded, snipped and filtered float32 buffer, which is shared by
+#            every render that only differs in the later stages
+# The whole directory is kept under max_bytes by evicting least-recently-used
+# entries. Several processes can share one directory (GUI jobs, daemon
+# workers): every read-modify-write of the index happens under a lock file, and
+# files only ever appear through a rename, so nobody sees half of one.
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "python_mastering_tool")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+INDEX_NAME = "index.json"
+LOCK_NAME = "index.lock"
+
+
+def canonical_hash(params):
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+# --- Cross-Process Files ---
+@contextlib.contextmanager
+def file_lock(lock_path):
+    """Holds an exclusive lock on lock_path for the with block, waiting for other processes."""
+    with open(lock_path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after ~10 s; the holder may be analysing a long file
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_atomically(path, write, binary=False):
+    """
+    Calls write(f) on a uniquely named temp file next to path, then renames it
+    over path. Readers see the old file or the new one, never a partial write.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                    suffix=".tmp")
+    try:
+        with (os.fdopen(fd, "wb") if binary else os.fdopen(fd, "w", encoding="utf-8")) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class FileHashes:
+    """SHA-256 of files by path, re-used while a file's size and mtime are unchanged."""
+
+    def __init__(self):
+        self._hashes = {}
+
+    def __call__(self, path):
+        import main
+
+        stat = os.stat(path)
+        stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if stamp not in self._hashes:
+            self._hashes[stamp] = main.generate_file_hash(path)
+        return self._hashes[stamp]
+
+
+def _copy_into(source, path):
+    def write(f):
+        with open(source, "rb") as src:
+            shutil.copyfileobj(src, f, 1 << 20)
+    write_atomically(path, write, binary=True)
+
+
+class RenderCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_path = os.path.join(cache_dir, INDEX_NAME)
+        self._lock_path = os.path.join(cache_dir, LOCK_NAME)
+        self._input_hashes = FileHashes()
+        with self._locked():
+            self._load_index()
+
+    # --- Index ---
+    def _locked(self):
+        # Every method that changes the index re-loads it under this lock first,
+        # so updates from other processes are never overwritten
+        return file_lock(self._lock_path)
+
+    def _load_index(self):
+        self.entries = {}
+        self.counters = {"render": {"hits": 0, "misses": 0}, "stage": {"hits": 0, "misses": 0}}
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.entries = data.get("entries", {})
+                self.counters.update(data.get("counters", {}))
+            except (OSError, json.JSONDecodeError):
+                # A broken index just means a cold cache
+                self.entries = {}
+
+    def _save_index(self):
+        write_atomically(self._index_path, lambda f: json.dump({"entries": self.entries, "counters": self.counters}, f))
+
+    # --- Keys ---
+    def input_hash(self, input_file):
+        # Re-use the hash while the file is unchanged, so repeated renders skip the read
+        return self._input_hashes(input_file)
+
+    def key(self, input_sha, kind, params):
+        return f"{kind}-{input_sha[:32]}-{canonical_hash(params)[:32]}"
+
+    # --- Lookup ---
+    def _lookup(self, key, kind, require=()):
+        # Caller holds the lock. An entry without every file in `require` is a
+        # miss, but is kept: the render that follows replaces it
+        self._load_index()
+        entry = self.entries.get(key)
+        if entry is not None and all(os.path.exists(os.path.join(self.cache_dir, name)) for name in entry["files"].values()):
+            if all(name in entry["files"] for name in require):
+                entry["last_used"] = time.time()
+                self.counters[kind]["hits"] += 1
+                self._save_index()
+                return entry
+        elif entry is not None:
+            self._drop(key)
+        self.counters[kind]["misses"] += 1
+        self._save_index()
+        return None
+
+    def _open_entry(self, key, kind, require=()):
+        # Only the lookup and the open() calls happen under the lock. An open
+        # file stays readable even if another process evicts it meanwhile, so
+        # the actual reads don't hold up the other processes
+        with self._locked():
+            entry = self._lookup(key, kind, require)
+            if entry is None:
+                return None, None
+            files = {}
+            try:
+                for role, name in entry["files"].items():
+                    files[role] = open(os.path.join(self.cache_dir, name), "rb")
+            except OSError:
+                for f in files.values():
+                    f.close()
+                raise
+        return entry, files
+
+    def get_render(self, key, output_file, need_analysis=False):
+        """
+        Copies a cached master (and its analysis PNG, if it has one) next to
+        output_file. Returns the stored render info, or None on a miss.
+        need_analysis: a render stored without a PNG counts as a miss.
+        """
+        entry, files = self._open_entry(key, "render", require=("analysis",) if need_analysis else ())
+        if entry is None:
+            return None
+        try:
+            with open(output_file, "wb") as out:
+                shutil.copyfileobj(files["output"], out, 1 << 20)
+            image_filename = None
+            if "analysis" in files:
+                import visualizer
+                image_filename = visualizer.analysis_image_path(output_file)
+                with open(image_filename, "wb") as out:
+                    shutil.copyfileobj(files["analysis"], out, 1 << 20)
+        finally:
+            for f in files.values():
+                f.close()
+        return dict(entry["meta"], output_file=output_file, analysis_image=image_filename)
+
+    def get_stage(self, key):
+        """Returns (buffer, meta, preview) for a cached stage buffer, or None on a miss."""
+        entry, files = self._open_entry(key, "stage")
+        if entry is None:
+            return None
+        try:
+            buffer = np.load(files["buffer"])
+            preview = None
+            if "preview" in files:
+                with np.load(files["preview"]) as data:
+                    preview = {name: data[name] for name in data.files}
+        finally:
+            for f in files.values():
+                f.close()
+        return buffer, entry["meta"], preview
+
+    # --- Store ---
+    def _store(self, key, files, meta):
+        # The files are already in place (written atomically, outside the lock)
+        size = sum(os.path.getsize(os.path.join(self.cache_dir, name)) for name in files.values())
+        with self._locked():
+            self._load_index()
+            self.entries[key] = {"files": files, "meta": meta, "size": size, "last_used": time.time()}
+            self._evict()
+            self._save_index()
+
+    def put_render(self, key, output_file, meta, image_filename=None):
+        files = {"output": key + os.path.splitext(output_file)[1]}
+        _copy_into(output_file, os.path.join(self.cache_dir, files["output"]))
+        if image_filename and os.path.exists(image_filename):
+            files["analysis"] = key + "_analysis.png"
+            _copy_into(image_filename, os.path.join(self.cache_dir, files["analysis"]))
+        self._store(key, files, meta)
+
+    def put_render_image(self, key, image_filename):
+        """Adds the analysis PNG to a stored render, for PNGs drawn after the audio was cached."""
+        name = key + "_analysis.png"
+        path = os.path.join(self.cache_dir, name)
+        _copy_into(image_filename, path)
+        with self._locked():
+            self._load_index()
+            entry = self.entries.get(key)
+            if entry is None or "analysis" in entry["files"]:
+                # Evicted meanwhile, or another render already added one
+                if entry is None:
+                    os.remove(path)
+                return
+            entry["files"]["analysis"] = name
+            entry["size"] += os.path.getsize(path)
+            self._evict()
+            self._save_index()
+
+    def put_stage(self, key, buffer, meta, preview=None):
+        files = {"buffer": key + ".npy"}
+        write_atomically(os.path.join(self.cache_dir, files["buffer"]), lambda f: np.save(f, buffer), binary=True)
+        if preview is not None:
+            # The visualizer's reduced view of the unprocessed audio
+            files["preview"] = key + "_preview.npz"
+            write_atomically(os.path.join(self.cache_dir, files["preview"]), lambda f: np.savez(f, **preview),
+                             binary=True)
+        self._store(key, files, meta)
+
+    # --- Eviction ---
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for name in entry["files"].values():
+            path = os.path.join(self.cache_dir, name)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                # Windows won't delete a file another process is still reading;
+                # the entry is gone either way, only the bytes linger
+                pass
+
+    def _evict(self):
+        total = sum(entry["size"] for entry in self.entries.values())
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= self.entries[key]["size"]
+            self._drop(key)
+
+    def clear(self):
+        with self._locked():
+            self._load_index()
+            for key in list(self.entries):
+                self._drop(key)
+            self._save_index()
+
+    def stats(self):
+        with self._locked():
+            self._load_index()
+        return {
+            "entries": len(self.entries),
+            "bytes": sum(entry["size"] for entry in self.entries.values()),
+            "max_bytes": self.max_bytes,
+            "render": dict(self.counters["render"]),
+            "stage": dict(self.counters["stage"]),
+        }
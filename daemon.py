@@ -0,0 +1,427 @@
+import argparse
+import concurrent.futures
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from jobs import CANCELLED, DONE, ERROR, QUEUED, RUNNING, summarize
+
+# Headless rendering. Run: python daemon.py <command>
+#
+#   render  snip_audio in this process (importing main is cheap; the heavy
+#           modules load when a stage first needs them)
+#   serve   a long-lived render daemon on localhost HTTP. Its worker processes
+#           import the whole engine once at start, so a job pays no
+#           interpreter or import startup, and they keep the EQ/filter design
+#           caches warm between jobs
+#   submit  send a job to a running daemon
+#
+# A job spec is a JSON object of snip_audio arguments:
+#   {"input_file": "/abs/in.wav", "start_sec": 0, "end_sec": 30,
+#    "output_file": "/abs/out.wav", "use_clipper": true, "multiband": true}
+# Relative paths are resolved by the daemon against its own working directory;
+# `submit` makes them absolute first.
+#
+# API (JSON in and out, loopback only). Listening on loopback doesn't keep
+# out a web page open in the user's browser, so every request must carry the
+# daemon's own Host, no Origin (browsers always send one on cross-site
+# requests), and POSTs must be application/json (which a page can't send
+# without a CORS preflight we never answer). With a token (--token or
+# MASTERING_DAEMON_TOKEN) requests also need "Authorization: Bearer <token>".
+#   POST   /jobs          queue a spec -> {"id": ...}; ?wait=1 answers when done
+#   GET    /jobs          all jobs
+#   GET    /jobs/<id>     one job, with "result" or "error" once finished
+#   DELETE /jobs/<id>     cancel a job that hasn't started
+#   GET    /health        pool state, worker count and queue length (503
+#                         while the pool restarts after a worker died)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_SPEC_BYTES = 1 << 20
+MAX_FINISHED_JOBS = 1000
+TOKEN_ENV = "MASTERING_DAEMON_TOKEN"
+LOOPBACK_NAMES = ("127.0.0.1", "localhost", "[::1]")
+# Supplied by the daemon, never by a spec
+RESERVED_ARGS = ("cache", "profiler")
+
+
+# --- Job Specs ---
+def validate_spec(spec):
+    """Checks a spec against snip_audio's signature. Returns the spec, or raises ValueError."""
+    import main
+
+    if not isinstance(spec, dict):
+        raise ValueError("a job spec must be a JSON object")
+    parameters = inspect.signature(main.snip_audio).parameters
+    unknown = sorted(key for key in spec if key not in parameters or key in RESERVED_ARGS)
+    if unknown:
+        raise ValueError(f"unknown job arguments: {', '.join(unknown)}")
+    missing = sorted(name for name, p in parameters.items()
+                     if p.default is inspect.Parameter.empty and name not in spec)
+    if missing:
+        raise ValueError(f"missing job arguments: {', '.join(missing)}")
+    return spec
+
+
+def _parse_value(text):
+    # --set values are JSON where they parse (numbers, true, {...}), strings otherwise
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+
+def spec_from_args(args):
+    spec = {"input_file": args.input_file, "start_sec": args.start_sec, "end_sec": args.end_sec,
+            "output_file": args.output_file}
+    for item in args.set or []:
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"--set expects key=value, got {item!r}")
+        spec[key.strip()] = _parse_value(value)
+    return spec
+
+
+def render(spec, cache_dir=None):
+    """Runs one spec in this process. Returns the JSON-able result summary."""
+    import main
+
+    started = time.perf_counter()
+    render_cache = None
+    if cache_dir is not None:
+        import cache
+        render_cache = cache.RenderCache(cache_dir)
+    result = main.snip_audio(cache=render_cache, **validate_spec(spec))
+    return dict(summarize(result), wall_sec=time.perf_counter() - started)
+
+
+# --- Workers ---
+def _warm_worker(preload_visualizer):
+    # Everything a render can touch, so the first job is as fast as the rest
+    import scipy.signal  # noqa: F401
+    import analysis  # noqa: F401
+    import cache  # noqa: F401
+    import dynamics  # noqa: F401
+    import eq  # noqa: F401
+    import main  # noqa: F401
+    import reference  # noqa: F401
+    import streaming  # noqa: F401
+    if preload_visualizer:
+        import visualizer  # noqa: F401
+
+
+def _worker_pid():
+    return os.getpid()
+
+
+def _pool_context():
+    # A pool rebuilt after the server is listening must not be forked from it,
+    # or its workers would hold the listening socket open
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+class PoolUnavailable(RuntimeError):
+    """The worker pool is restarting after a worker died; try again shortly."""
+
+
+class RenderDaemon:
+    """
+    A pool of warm worker processes plus the job table the HTTP handler reads.
+    If a worker dies (OOM kill, segfault) the executor is broken for good:
+    its in-flight jobs fail, and a fresh pool is started in the background.
+    Until it is warm, submit() raises PoolUnavailable.
+    """
+
+    def __init__(self, workers=None, cache_dir=None, preload_visualizer=True):
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.cache_dir = cache_dir
+        self.preload_visualizer = preload_visualizer
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._start_pool()
+
+    # --- Pool ---
+    def _start_pool(self):
+        while True:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=_pool_context(),
+                initializer=_warm_worker, initargs=(self.preload_visualizer,))
+
+            # Start (and warm) every worker now rather than on the first jobs
+            started = time.perf_counter()
+            try:
+                pings = [pool.submit(_worker_pid) for _ in range(self.workers)]
+                pids = {future.result() for future in pings}
+                break
+            except BrokenProcessPool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                print("Daemon: a worker died while warming up; retrying")
+                time.sleep(1.0)
+        print(f"Daemon: {len(pids)} workers warm in {time.perf_counter() - started:.2f}s")
+        with self._lock:
+            self._pool = pool
+
+    def _pool_broken(self, pool):
+        with self._lock:
+            if self._pool is not pool:
+                # Already being replaced
+                return
+            self._pool = None
+        print("Daemon: a worker process died; restarting the pool")
+        pool.shutdown(wait=False, cancel_futures=True)
+        threading.Thread(target=self._start_pool, daemon=True).start()
+
+    @property
+    def ready(self):
+        """
+        False while the pool is being replaced. This is the state the
+        BrokenProcessPool handling in submit() and _finished() keeps, so
+        checking it costs no work on the pool; a pool that broke while idle
+        is noticed by the next submit().
+        """
+        return self._pool is not None
+
+    # --- Jobs ---
+    def submit(self, spec):
+        validate_spec(spec)
+        with self._lock:
+            pool = self._pool
+            if pool is None:
+                raise PoolUnavailable("worker pool is restarting")
+            try:
+                future = pool.submit(render, spec, self.cache_dir)
+            except BrokenProcessPool:
+                future = None
+            if future is not None:
+                job_id = next(self._ids)
+                job = {"id": job_id, "spec": spec, "status": QUEUED, "submitted": time.time(), "future": future}
+                self.jobs[job_id] = job
+                self._prune()
+        if future is None:
+            self._pool_broken(pool)
+            raise PoolUnavailable("a worker died; worker pool is restarting")
+        future.add_done_callback(lambda future, job=job, pool=pool: self._finished(job, future, pool))
+        return job_id
+
+    def _finished(self, job, future, pool):
+        job["finished"] = time.time()
+        if future.cancelled():
+            job["status"] = CANCELLED
+        elif future.exception() is not None:
+            error = future.exception()
+            job["status"], job["error"] = ERROR, f"{type(error).__name__}: {error}"
+        else:
+            job["status"], job["result"] = DONE, future.result()
+        print(f"Daemon [{job['status']}] #{job['id']} {job['spec'].get('output_file')}")
+        if job["status"] == ERROR and isinstance(future.exception(), BrokenProcessPool):
+            # Every job still on that pool fails the same way; replace it once
+            self._pool_broken(pool)
+
+    def _prune(self):
+        # Forget the oldest finished jobs so a long-lived daemon doesn't grow without bound
+        finished = [job_id for job_id, job in self.jobs.items() if job["status"] in (DONE, ERROR, CANCELLED)]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def status(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job["status"] == QUEUED and job["future"].running():
+            job["status"] = RUNNING
+        return {key: value for key, value in job.items() if key != "future"}
+
+    def wait(self, job_id):
+        job = self.jobs[job_id]
+        concurrent.futures.wait([job["future"]])
+        # The done callback may still be running on the pool's thread
+        while "finished" not in job:
+            time.sleep(0.01)
+        return self.status(job_id)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        return job is not None and job["future"].cancel()
+
+    def health(self):
+        statuses = [self.status(job_id)["status"] for job_id in list(self.jobs)]
+        return {"pool": "ready" if self.ready else "restarting", "workers": self.workers,
+                "queued": statuses.count(QUEUED), "running": statuses.count(RUNNING), "cache_dir": self.cache_dir}
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+# --- HTTP ---
+class _Handler(BaseHTTPRequestHandler):
+    render_daemon = None
+    allowed_hosts = ()
+    token = None
+
+    def _send(self, code, body):
+        data = json.dumps(body, default=str).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job_id(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            return int(parts[1])
+        return None
+
+    def _refused(self, json_body=False):
+        """Sends an error and returns True unless the request is from a local client we trust."""
+        if self.headers.get("Origin") is not None:
+            self._send(403, {"error": "cross-origin requests are not accepted"})
+        elif self.headers.get("Host") not in self.allowed_hosts:
+            self._send(403, {"error": "unexpected Host header"})
+        elif self.token and self.headers.get("Authorization") != f"Bearer {self.token}":
+            self._send(401, {"error": "missing or wrong token"})
+        elif json_body and self.headers.get_content_type() != "application/json":
+            self._send(415, {"error": "job specs must be sent as application/json"})
+        else:
+            return False
+        return True
+
+    def do_GET(self):
+        if self._refused():
+            return
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/health":
+            health = self.render_daemon.health()
+            return self._send(200 if health["pool"] == "ready" else 503, health)
+        if path == "/jobs":
+            return self._send(200, [self.render_daemon.status(job_id) for job_id in list(self.render_daemon.jobs)])
+        job_id = self._job_id()
+        status = self.render_daemon.status(job_id) if job_id is not None else None
+        if status is None:
+            return self._send(404, {"error": "no such job"})
+        self._send(200, status)
+
+    def do_POST(self):
+        if self._refused(json_body=True):
+            return
+        path, _, query = self.path.partition("?")
+        if path.rstrip("/") != "/jobs":
+            return self._send(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_SPEC_BYTES:
+            return self._send(413, {"error": "job spec too large"})
+        try:
+            job_id = self.render_daemon.submit(json.loads(self.rfile.read(length) or b"null"))
+        except (ValueError, TypeError) as e:
+            return self._send(400, {"error": str(e)})
+        except PoolUnavailable as e:
+            return self._send(503, {"error": str(e)})
+        if "wait=1" in query.split("&"):
+            return self._send(200, self.render_daemon.wait(job_id))
+        self._send(202, {"id": job_id})
+
+    def do_DELETE(self):
+        if self._refused():
+            return
+        job_id = self._job_id()
+        if job_id is None or job_id not in self.render_daemon.jobs:
+            return self._send(404, {"error": "no such job"})
+        if not self.render_daemon.cancel(job_id):
+            return self._send(409, {"error": "job already started or finished"})
+        self._send(200, self.render_daemon.status(job_id))
+
+    def log_message(self, format, *args):
+        print(f"Daemon: {self.address_string()} {format % args}")
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None, cache_dir=None, preload_visualizer=True, token=None):
+    daemon = RenderDaemon(workers=workers, cache_dir=cache_dir, preload_visualizer=preload_visualizer)
+    handler = type("Handler", (_Handler,), {"render_daemon": daemon, "token": token or os.environ.get(TOKEN_ENV)})
+    server = ThreadingHTTPServer((host, port), handler)
+    # Only names of this daemon, so a rebound DNS name can't reach it either
+    handler.allowed_hosts = {f"{name}:{server.server_port}" for name in set(LOOPBACK_NAMES) | {host}}
+    print(f"Daemon: listening on http://{host}:{server.server_port}")
+    # A plain `kill` shuts down like Ctrl+C, so the workers go with the daemon
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.shutdown()
+
+
+# --- Client ---
+def submit(spec, url=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", wait=False, timeout=None, token=None):
+    """Sends a spec to a running daemon. Returns {"id": ...}, or the finished job when wait=True."""
+    spec = dict(spec)
+    for key in ("input_file", "output_file", "reference"):
+        if isinstance(spec.get(key), str):
+            spec[key] = os.path.abspath(spec[key])
+    headers = {"Content-Type": "application/json"}
+    token = token or os.environ.get(TOKEN_ENV)
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    request = urllib.request.Request(f"{url}/jobs" + ("?wait=1" if wait else ""), method="POST",
+                                     data=json.dumps(spec).encode("utf-8"), headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise ValueError(json.loads(e.read()).get("error", str(e))) from None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless mastering renders and the render daemon.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_args = commands.add_parser("serve", help="run the render daemon")
+    serve_args.add_argument("--host", default=DEFAULT_HOST)
+    serve_args.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_args.add_argument("--workers", type=int)
+    serve_args.add_argument("--cache-dir", help="render cache shared by the workers (default: no cache)")
+    serve_args.add_argument("--token", help=f"require this bearer token (default: ${TOKEN_ENV}, if set)")
+    serve_args.add_argument("--no-visualizer", action="store_true",
+                            help="don't preload matplotlib/librosa (for jobs with visualize=null)")
+
+    for name, help_text in (("render", "render one job in this process"), ("submit", "send a job to the daemon")):
+        job_args = commands.add_parser(name, help=help_text)
+        job_args.add_argument("input_file")
+        job_args.add_argument("start_sec", type=float)
+        job_args.add_argument("end_sec", type=float)
+        job_args.add_argument("output_file")
+        job_args.add_argument("--set", action="append", metavar="KEY=VALUE",
+                              help="any other snip_audio argument, value as JSON (repeatable)")
+        if name == "render":
+            job_args.add_argument("--cache-dir")
+        else:
+            job_args.add_argument("--url", default=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}")
+            job_args.add_argument("--wait", action="store_true", help="block until the render is done")
+            job_args.add_argument("--token", help=f"bearer token (default: ${TOKEN_ENV})")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args.host, args.port, args.workers, args.cache_dir, preload_visualizer=not args.no_visualizer,
+              token=args.token)
+    elif args.command == "render":
+        print(json.dumps(render(spec_from_args(args), args.cache_dir), indent=2, default=str))
+    else:
+        print(json.dumps(submit(spec_from_args(args), args.url, wait=args.wait, token=args.token), indent=2,
+                         default=str))
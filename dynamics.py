@@ -0,0 +1,314 @@
+import functools
+import numpy as np
+from scipy.ndimage import minimum_filter1d
+from scipy.signal import butter, firwin, lfilter, resample_poly, sosfilt
+
+import engine
+
+# Dynamics processors that work on float32 (frames, channels) buffers.
+
+LIMITER_BLOCK_FRAMES = 65536
+# Input frames either side of a block the oversampling filter needs to see
+TRUE_PEAK_MARGIN = 16
+# Taps per polyphase branch of the true-peak interpolator
+TRUE_PEAK_TAPS_PER_PHASE = 20
+
+
+@functools.lru_cache(maxsize=None)
+def _true_peak_fir(oversample):
+    taps = TRUE_PEAK_TAPS_PER_PHASE * oversample + 1
+    return firwin(taps, 1.0 / oversample, window=("kaiser", 5.0)).astype(np.float32)
+
+
+def true_peak_envelope(block, oversample=4):
+    """Per-frame true peak: max |x| over all channels of the oversampled signal."""
+    if oversample <= 1:
+        return np.max(np.abs(block), axis=1)
+
+    upsampled = resample_poly(block, oversample, 1, axis=0, window=_true_peak_fir(oversample))
+    np.abs(upsampled, out=upsampled)
+    # (frames * oversample, channels) -> (frames, oversample * channels), then max per frame
+    columns = upsampled.reshape(len(block), -1)
+    envelope = columns[:, 0].copy()
+    for k in range(1, columns.shape[1]):
+        np.maximum(envelope, columns[:, k], out=envelope)
+    return envelope
+
+
+# --- True-Peak Limiter ---
+class TruePeakLimiter:
+    """
+    Look-ahead brickwall limiter on the oversampled (true) peak.
+
+    The gain computer is vectorized per block:
+      1. required gain per frame, from the true-peak envelope vs the ceiling
+      2. sliding minimum over the look-ahead window (scipy's monotonic-queue
+         min filter), so the gain is already down when the peak arrives
+      3. moving average over the same window as the attack ramp; it never
+         rises above step 2 at the peak itself
+      4. release as a linear recovery in dB, g[n] = min(s[n], g[n-1] + step),
+         which unrolls to a cumulative minimum, so no per-sample loop.
+
+    Feed blocks with process() and collect the rest with flush(). Output lags
+    input by the look-ahead, so the two together return every frame once.
+    """
+
+    def __init__(self, sample_rate, channels, ceiling=-1.0, lookahead_ms=5.0, release_ms=80.0, oversample=4):
+        self.threshold = engine.db_to_gain(ceiling)
+        self.lookahead = max(1, int(sample_rate * lookahead_ms / 1000.0))
+        # release_ms: time to recover 6 dB of gain reduction
+        self.release_step = 6.0 / max(1.0, sample_rate * release_ms / 1000.0)
+        self.oversample = oversample
+        self.channels = channels
+
+        self._pending = np.zeros((0, channels), dtype=np.float32)
+        self._history = np.zeros((TRUE_PEAK_MARGIN, channels), dtype=np.float32)
+        self._held_tail = None
+        self._gain_db = 0.0
+
+    def _required_gain_db(self, audio, final):
+        # Envelope for the frames of `audio`, with the previous frames as left margin
+        ext = np.concatenate([self._history, audio])
+        envelope = true_peak_envelope(ext, self.oversample)[TRUE_PEAK_MARGIN:]
+        if not final:
+            envelope = envelope[:len(audio) - TRUE_PEAK_MARGIN]
+
+        required = np.zeros(len(envelope), dtype=np.float64)
+        over = envelope > self.threshold
+        required[over] = 20 * np.log10(self.threshold / envelope[over])
+        return required
+
+    def _run(self, n, final=False):
+        if n == 0:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        L = self.lookahead
+        want = n + L - 1 + (0 if final else TRUE_PEAK_MARGIN)
+        audio = self._pending[:want]
+        required = self._required_gain_db(audio, final)
+
+        # 2. look-ahead hold: held[k] = min(required[k .. k+L-1])
+        held = minimum_filter1d(required, size=L, origin=-(L // 2), mode="nearest")[:n]
+
+        # 3. attack ramp: smoothed[k] = mean(held[k-L+1 .. k])
+        tail = self._held_tail if self._held_tail is not None else np.full(L - 1, held[0])
+        sums = np.cumsum(np.concatenate([[0.0], tail, held]))
+        smoothed = (sums[L:] - sums[:-L]) / L
+
+        # 4. release: g[k] = min over j <= k of (smoothed[j] + (k - j) * step), seeded by the last block
+        ramp = np.arange(1, n + 1) * self.release_step
+        gain_db = np.minimum.accumulate(smoothed - ramp) + ramp
+        np.minimum(gain_db, self._gain_db + ramp, out=gain_db)
+
+        out = self._pending[:n] * engine.db_to_gain(gain_db).astype(np.float32)[:, None]
+
+        self._gain_db = float(gain_db[-1])
+        self._held_tail = np.concatenate([tail, held])[-(L - 1):] if L > 1 else np.zeros(0)
+        self._history = np.concatenate([self._history, self._pending[:n]])[-TRUE_PEAK_MARGIN:]
+        self._pending = self._pending[n:]
+        return out
+
+    def process(self, block, chunk_frames=LIMITER_BLOCK_FRAMES):
+        self._pending = np.concatenate([self._pending, block])
+        outputs = []
+        delay = self.lookahead - 1 + TRUE_PEAK_MARGIN
+        while len(self._pending) - delay >= chunk_frames:
+            outputs.append(self._run(chunk_frames))
+        if not outputs:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        return np.concatenate(outputs) if len(outputs) > 1 else outputs[0]
+
+    def flush(self):
+        return self._run(len(self._pending), final=True)
+
+
+def apply_true_peak_limiter(buffer, sample_rate, ceiling=-1.0, lookahead_ms=5.0, release_ms=80.0, oversample=4):
+    """Limits a whole buffer in place, block by block."""
+    limiter = TruePeakLimiter(sample_rate, buffer.shape[1], ceiling=ceiling, lookahead_ms=lookahead_ms,
+                              release_ms=release_ms, oversample=oversample)
+    return engine.process_in_place(limiter, buffer, LIMITER_BLOCK_FRAMES)
+
+
+# --- Oversampled Soft Clipper ---
+CLIP_BLOCK_FRAMES = 65536
+# Taps per polyphase branch of the clipper's up/down-sampling filters
+CLIP_TAPS_PER_PHASE = 16
+# Input frames either side of a block the two filters need to see
+CLIP_MARGIN = CLIP_TAPS_PER_PHASE + 8
+CLIP_OVERSAMPLE_RATIOS = (1, 2, 4, 8)
+
+
+@functools.lru_cache(maxsize=None)
+def _clip_fir(oversample):
+    taps = CLIP_TAPS_PER_PHASE * oversample + 1
+    return firwin(taps, 1.0 / oversample, window=("kaiser", 8.0)).astype(np.float32)
+
+
+class SoftClipper:
+    """
+    tanh saturation run at `oversample` times the sample rate, so the harmonics
+    it creates above the original Nyquist are filtered out instead of folding
+    back as aliasing. Up- and down-sampling are polyphase (resample_poly), on
+    blocks with CLIP_MARGIN frames of context either side.
+
+    Like TruePeakLimiter, output lags input: feed blocks with process() and
+    collect the last CLIP_MARGIN frames with flush(). oversample=1 is the plain
+    native-rate tanh with no delay.
+    """
+
+    def __init__(self, channels, drive_db=3.0, oversample=4):
+        if oversample not in CLIP_OVERSAMPLE_RATIOS:
+            raise ValueError(f"oversample must be one of {CLIP_OVERSAMPLE_RATIOS}")
+        self.drive = np.float32(engine.db_to_gain(drive_db))
+        self.oversample = oversample
+        self.channels = channels
+        # Left context plus frames still waiting for their right context
+        self._context = np.zeros((CLIP_MARGIN if oversample > 1 else 0, channels), dtype=np.float32)
+
+    def _saturate(self, audio):
+        audio *= self.drive
+        if self.oversample > 1:
+            fir = _clip_fir(self.oversample)
+            audio = resample_poly(audio, self.oversample, 1, axis=0, window=fir)
+            np.tanh(audio, out=audio)
+            audio = resample_poly(audio, 1, self.oversample, axis=0, window=fir)
+        else:
+            np.tanh(audio, out=audio)
+        audio /= self.drive
+        return audio
+
+    def process(self, block):
+        if self.oversample == 1:
+            return self._saturate(block.copy())
+
+        M = CLIP_MARGIN
+        ext = np.concatenate([self._context, block])
+        ready = len(ext) - 2 * M
+        if ready <= 0:
+            self._context = ext
+            return np.zeros((0, self.channels), dtype=np.float32)
+        self._context = ext[-2 * M:].copy()
+        return self._saturate(ext)[M:M + ready]
+
+    def flush(self):
+        if self.oversample == 1:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        pending = len(self._context) - CLIP_MARGIN
+        out = self.process(np.zeros((CLIP_MARGIN, self.channels), dtype=np.float32))
+        return out[:pending]
+
+
+def apply_soft_clip(buffer, drive_db=3.0, oversample=4):
+    """Soft-clips a whole buffer in place, block by block."""
+    clipper = SoftClipper(buffer.shape[1], drive_db=drive_db, oversample=oversample)
+    return engine.process_in_place(clipper, buffer, CLIP_BLOCK_FRAMES)
+
+
+# --- Multiband Compressor ---
+MB_BLOCK_FRAMES = 65536
+
+
+def linkwitz_riley_sos(freq, sample_rate, btype):
+    """4th-order Linkwitz-Riley low/high-pass: a 2nd-order Butterworth run twice."""
+    sos = butter(2, freq, btype=btype, fs=sample_rate, output="sos")
+    return np.vstack([sos, sos]).astype(np.float32)
+
+
+def linkwitz_riley_allpass_sos(freq, sample_rate):
+    """The allpass an LR4 low + high pair sums to; lower bands go through it to stay in phase."""
+    a = butter(2, freq, btype="low", fs=sample_rate, output="sos")[0, 3:]
+    return np.concatenate([a[::-1], a])[None, :].astype(np.float32)
+
+
+class MultibandCompressor:
+    """
+    3- or 4-band downward compressor (2 or 3 crossover frequencies).
+
+    The bands come from a Linkwitz-Riley (LR4) crossover tree. Each split
+    passes the bands below it through the matching allpass, so the bands
+    sum back to a flat (allpass) response. All bands live side by side in one
+    (frames, bands * channels) array, so the allpass compensation and every
+    envelope stage run once per block across all of them.
+
+    The envelope is vectorized like the limiter's gain curve: a peak detector
+    in dB with linear release, env[n] = max(level[n], env[n-1] - step), as a
+    cumulative maximum, then a one-pole attack smoother (lfilter) on the gain
+    reduction. Channels are linked per band. Filter and envelope state carry
+    over between process() calls, so blocks join up.
+    threshold_db / ratio / makeup_db take a scalar or one value per band.
+    """
+
+    def __init__(self, sample_rate, channels, crossovers=(200.0, 3000.0), threshold_db=-18.0, ratio=2.0,
+                 attack_ms=10.0, release_ms=150.0, makeup_db=0.0):
+        crossovers = sorted(crossovers)
+        if len(crossovers) not in (2, 3):
+            raise ValueError("crossovers needs 2 (3 bands) or 3 (4 bands) frequencies")
+        self.channels = channels
+        self.bands = len(crossovers) + 1
+        self.splits = [(linkwitz_riley_sos(f, sample_rate, "low"),
+                        linkwitz_riley_sos(f, sample_rate, "high"),
+                        linkwitz_riley_allpass_sos(f, sample_rate)) for f in crossovers]
+
+        self.threshold_db = np.broadcast_to(np.asarray(threshold_db, dtype=np.float64), (self.bands,))
+        self.slope = 1.0 - 1.0 / np.broadcast_to(np.asarray(ratio, dtype=np.float64), (self.bands,))
+        self.makeup = engine.db_to_gain(np.broadcast_to(np.asarray(makeup_db, dtype=np.float64), (self.bands,)))
+        # release_ms: time to recover 6 dB, as in the limiter
+        self.release_step = 6.0 / max(1.0, sample_rate * release_ms / 1000.0)
+        coeff = np.exp(-1.0 / max(1.0, sample_rate * attack_ms / 1000.0))
+        self.attack = ([1.0 - coeff], [1.0, -coeff])
+
+        self._zi = {}
+        self._env_db = np.full(self.bands, -np.inf)
+        self._attack_zi = np.zeros((1, self.bands))
+
+    def _sos(self, key, sos, audio):
+        zi = self._zi.get(key)
+        if zi is None:
+            zi = np.zeros((sos.shape[0], 2, audio.shape[1]), dtype=np.float32)
+        out, self._zi[key] = sosfilt(sos, audio, axis=0, zi=zi)
+        return out
+
+    def split(self, block):
+        """(frames, channels) -> (frames, bands * channels), lowest band first."""
+        lows = None
+        rest = block
+        for i, (low_sos, high_sos, allpass_sos) in enumerate(self.splits):
+            if lows is not None:
+                lows = self._sos(("allpass", i), allpass_sos, lows)
+            low = self._sos(("low", i), low_sos, rest)
+            rest = self._sos(("high", i), high_sos, rest)
+            lows = low if lows is None else np.concatenate([lows, low], axis=1)
+        return np.concatenate([lows, rest], axis=1)
+
+    def gain_db(self, bands):
+        """Per-frame, per-band gain in dB for a (frames, bands, channels) array."""
+        level = np.max(np.abs(bands), axis=2)
+        with np.errstate(divide="ignore"):
+            level_db = 20 * np.log10(level, dtype=np.float64)
+
+        # Peak envelope, linear release in dB, seeded by the previous block
+        ramp = np.arange(len(level_db))[:, None] * self.release_step
+        env_db = np.maximum.accumulate(level_db + ramp, axis=0) - ramp
+        np.maximum(env_db, self._env_db - ramp - self.release_step, out=env_db)
+        self._env_db = env_db[-1].copy()
+
+        reduction = np.maximum(env_db - self.threshold_db, 0.0) * self.slope
+        reduction, self._attack_zi = lfilter(*self.attack, reduction, axis=0, zi=self._attack_zi)
+        return -reduction
+
+    def process(self, block):
+        """Compresses a (frames, channels) block in place."""
+        if not len(block):
+            return block
+        bands = self.split(block).reshape(len(block), self.bands, self.channels)
+        gain = engine.db_to_gain(self.gain_db(bands)) * self.makeup
+        bands *= gain.astype(np.float32)[:, :, None]
+        np.sum(bands, axis=1, out=block)
+        return block
+
+
+def apply_multiband_compressor(buffer, sample_rate, **settings):
+    """Compresses a whole buffer in place, block by block."""
+    compressor = MultibandCompressor(sample_rate, buffer.shape[1], **settings)
+    for pos in range(0, len(buffer), MB_BLOCK_FRAMES):
+        compressor.process(buffer[pos:pos + MB_BLOCK_FRAMES])
+    return buffer
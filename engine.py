@@ -0,0 +1,431 @@
+import numpy as np
+from pydub import AudioSegment
+
+# scipy.signal costs most of a second to import, so the stages that need it
+# import it themselves; a cache hit or a headless job that never filters skips it.
+
+# Signal-chain engine: the track is decoded once into a float32 (frames, channels)
+# buffer in the -1.0..1.0 range, every stage works on that buffer in place, and
+# we only go back to integers at export.
+
+INT_TYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+def full_scale(sample_width):
+    return float(2 ** (8 * sample_width - 1))
+
+
+# --- Decode / Encode ---
+QUANTIZE_BLOCK_FRAMES = 65536
+
+
+def segment_to_buffer(audio_segment):
+    # View the raw PCM bytes directly, the float32 buffer is the only copy
+    samples = np.frombuffer(audio_segment.raw_data, dtype=INT_TYPES[audio_segment.sample_width])
+    buffer = samples.reshape((-1, audio_segment.channels)).astype(np.float32)
+    buffer *= np.float32(1.0 / full_scale(audio_segment.sample_width))
+    return buffer
+
+
+# --- Dither ---
+# TPDF dither, in LSBs of the target format, added in the same pass that rounds
+# to integers. The shapes are FIR filters on the noise itself (not error
+# feedback, which can't be vectorized), so they only move the dither's own
+# spectrum: "highpass" differences successive uniform draws, "shaped" pushes
+# the noise towards the top octave where hearing is least sensitive.
+DITHER_SHAPES = {
+    "flat": np.array([1.0], dtype=np.float32),
+    "highpass": np.array([1.0, -1.0], dtype=np.float32),
+    "shaped": np.array([1.0, -1.623, 0.982, -0.109], dtype=np.float32),
+}
+# What "auto" picks per sample width: shape 16-bit, plain TPDF at 24-bit,
+# nothing at 32-bit where the noise would sit far below any DAC
+AUTO_DITHER = {1: "flat", 2: "shaped", 3: "flat", 4: None}
+
+
+class Dither:
+    """Dither noise generator; keeps the FIR history so consecutive blocks join up."""
+
+    def __init__(self, shape="flat", seed=None):
+        if shape not in DITHER_SHAPES:
+            raise ValueError(f"Unknown dither shape {shape!r}, expected one of {sorted(DITHER_SHAPES)}")
+        self.shape = shape
+        self.taps = DITHER_SHAPES[shape]
+        self.rng = np.random.default_rng(seed)
+        self._history = None
+
+    def _base(self, shape):
+        if self.shape == "highpass":
+            # Differencing one uniform sequence already gives a triangular PDF
+            return self.rng.random(shape, dtype=np.float32)
+        base = self.rng.random(shape, dtype=np.float32)
+        base += self.rng.random(shape, dtype=np.float32)
+        base -= np.float32(1.0)
+        return base
+
+    def noise(self, frames, channels):
+        base = self._base((frames, channels))
+        if len(self.taps) == 1:
+            return base
+
+        order = len(self.taps) - 1
+        if self._history is None:
+            self._history = self._base((order, channels))
+        padded = np.concatenate([self._history, base])
+        out = self.taps[0] * padded[order:]
+        for k in range(1, order + 1):
+            out += self.taps[k] * padded[order - k:order - k + frames]
+        self._history = padded[-order:]
+        return out
+
+
+def make_dither(dither, sample_width, seed=None):
+    """Dither instance for a snip_audio-style setting: a shape name, "auto" or None."""
+    if dither == "auto":
+        dither = AUTO_DITHER.get(sample_width)
+    if not dither or dither == "none":
+        return None
+    return Dither(dither, seed=seed)
+
+
+def quantize(buffer, sample_width=2, dither=None):
+    """
+    Quantize the float buffer to an integer PCM array. This is the only place in
+    the chain where the signal leaves float32. sample_width 3 gives 24-bit
+    values in an int32 array. `dither` is an optional Dither, applied before rounding.
+    """
+    scale = full_scale(sample_width)
+    # Largest float32 that still fits the integer type (2**31 - 1 isn't representable)
+    upper = min(np.float32(scale - 1), np.nextafter(np.float32(scale), np.float32(0)))
+    pcm = np.empty(buffer.shape, dtype=INT_TYPES.get(sample_width, np.int32))
+
+    # Block-wise so the float temporaries stay small
+    for pos in range(0, len(buffer), QUANTIZE_BLOCK_FRAMES):
+        blk = slice(pos, pos + QUANTIZE_BLOCK_FRAMES)
+        scaled = buffer[blk] * np.float32(scale)
+        if dither is not None:
+            scaled += dither.noise(*scaled.shape)
+        np.rint(scaled, out=scaled)
+        np.clip(scaled, -scale, upper, out=scaled)
+        pcm[blk] = scaled
+    return pcm
+
+
+def buffer_to_segment(buffer, sample_rate, sample_width=2, dither=None):
+    pcm = quantize(buffer, sample_width, dither)
+    return AudioSegment(data=pcm.tobytes(), sample_width=sample_width,
+                        frame_rate=sample_rate, channels=buffer.shape[1])
+
+
+# --- Snip Points ---
+ZERO_CROSSING_SEARCH_SEC = 0.020
+
+
+def zero_crossing_frame(window, target):
+    """
+    Index of the zero crossing in `window` (frames, channels) nearest to frame
+    `target`, or `target` if there is none. Channels are summed so the cut
+    lands where the frame as a whole crosses, and of the two frames around
+    the crossing the quieter one is picked.
+    """
+    mono = window.sum(axis=1, dtype=np.float64)
+    crossings = np.flatnonzero(np.diff(np.signbit(mono)))
+    if not len(crossings):
+        return target
+    nearest = int(crossings[np.abs(crossings - target).argmin()])
+    level = np.abs(window[nearest:nearest + 2]).max(axis=1)
+    return nearest + int(level.argmin())
+
+
+def snap_to_zero_crossing(reader, frame):
+    """
+    Moves `frame` to the nearest zero crossing within +-20 ms. `reader` needs
+    read(start, end) -> float32 frames plus sample_rate and frames attributes;
+    only the search window is decoded.
+    """
+    search = int(ZERO_CROSSING_SEARCH_SEC * reader.sample_rate)
+    lo = max(0, frame - search)
+    hi = min(reader.frames, frame + search)
+    if hi - lo < 2:
+        return frame
+    return lo + zero_crossing_frame(reader.read(lo, hi), frame - lo)
+
+
+def db_to_gain(db):
+    return 10 ** (db / 20.0)
+
+
+# --- Block Processing ---
+def process_in_place(processor, buffer, block_frames):
+    """
+    Runs a whole buffer through a process()/flush() processor whose output
+    lags its input, writing the output back over the buffer. process()
+    copies whatever it holds on to, so writing behind the read position is safe.
+    """
+    out_pos = 0
+    for pos in range(0, len(buffer), block_frames):
+        out = processor.process(buffer[pos:pos + block_frames])
+        buffer[out_pos:out_pos + len(out)] = out
+        out_pos += len(out)
+    out = processor.flush()
+    buffer[out_pos:out_pos + len(out)] = out
+    return buffer
+
+
+# --- EQ Filters ---
+# The IIR stages take an optional `state` dict. When given, the filter memory is
+# read from and written back to it, so consecutive blocks of one stream filter
+# exactly like a single buffer would (see streaming.py).
+def _filter_in_place(buffer, b, a, state=None, key=None, zi=None):
+    from scipy.signal import lfilter
+
+    b = np.asarray(b, dtype=np.float32)
+    a = np.asarray(a, dtype=np.float32)
+    if state is not None:
+        zi = state.get(key, zi)
+        if zi is None:
+            zi = np.zeros((max(len(a), len(b)) - 1, buffer.shape[1]), dtype=np.float32)
+    if zi is None:
+        buffer[:] = lfilter(b, a, buffer, axis=0)
+    else:
+        buffer[:], zf = lfilter(b, a, buffer, axis=0, zi=zi)
+        if state is not None:
+            state[key] = zf
+    return buffer
+
+
+def apply_high_pass(buffer, sample_rate, cutoff, state=None):
+    # Same first-order RC filter pydub's high_pass_filter uses
+    if not cutoff or not len(buffer):
+        return buffer
+    rc = 1.0 / (cutoff * 2 * np.pi)
+    dt = 1.0 / sample_rate
+    alpha = rc / (rc + dt)
+    return _filter_in_place(buffer, [alpha, -alpha], [1.0, -alpha], state, "high_pass")
+
+
+def apply_low_pass(buffer, sample_rate, cutoff, state=None):
+    # Same first-order RC filter pydub's low_pass_filter uses
+    from scipy.signal import lfilter_zi
+
+    if not cutoff or not len(buffer):
+        return buffer
+    rc = 1.0 / (cutoff * 2 * np.pi)
+    dt = 1.0 / sample_rate
+    alpha = dt / (rc + dt)
+    b, a = [alpha], [1.0, alpha - 1.0]
+    # Start the filter settled on the first sample, like pydub does
+    zi = lfilter_zi(b, a)[:, None] * buffer[:1]
+    return _filter_in_place(buffer, b, a, state, "low_pass", zi=zi.astype(np.float32))
+
+
+def apply_til_eq(buffer, sample_rate, tilt_amount=0, state=None):
+    """
+    tilt_amount: dB gain/cut at the frequency extremes.
+    Positive = Brighter (High boost, Low cut)
+    Negative = Warmer (Low boost, High cut)
+    """
+    if tilt_amount == 0.0:
+        return buffer
+
+    gain = 10**(tilt_amount / 40.0) # Distributed gain
+    alpha = (gain - 1) / (gain + 1)
+    return _filter_in_place(buffer, [1.0, alpha], [1.0, alpha * 0.5], state, "tilt")
+
+
+# --- Mid/Side ---
+MS_BLOCK_FRAMES = 65536
+
+
+def apply_mid_side(buffer, sample_rate, side_gain_db=0.0, width_factor=1.0, side_hp=500, low_side_gain=0.0, state=None):
+    """
+    One pass of M/S encode -> per-band side processing -> decode, in place.
+    The side channel is split at side_hp: the band above gets side_gain_db,
+    the band below is scaled by low_side_gain (0.0 keeps the low end mono),
+    and width_factor scales the whole side on top of that.
+    Works in blocks so the only temporaries are one block of side signal.
+    """
+    from scipy.signal import butter, sosfilt
+
+    if buffer.shape[1] < 2:
+        return buffer
+
+    high_gain = db_to_gain(side_gain_db) * width_factor
+    low_gain = low_side_gain * width_factor
+    split = side_hp and high_gain != low_gain
+    if not split and high_gain == 1.0:
+        return buffer
+
+    sos = butter(1, side_hp, btype="highpass", fs=sample_rate, output="sos") if split else None
+    zi = np.zeros((sos.shape[0], 2)) if split else None
+    if split and state is not None:
+        zi = state.get("side_hp", zi)
+
+    left, right = buffer[:, 0], buffer[:, 1]
+    for pos in range(0, len(buffer), MS_BLOCK_FRAMES):
+        blk = slice(pos, pos + MS_BLOCK_FRAMES)
+        l, r = left[blk], right[blk]
+
+        # Encode: S = (L - R) / 2, and L becomes M = (L + R) / 2
+        side = np.subtract(l, r)
+        side *= np.float32(0.5)
+        l -= side
+
+        # Side processing: S' = low * S_low + high * S_high, with S_low = S - S_high
+        if split:
+            side_high, zi = sosfilt(sos, side, zi=zi)
+            side *= np.float32(low_gain)
+            side += (side_high * (high_gain - low_gain)).astype(np.float32)
+        else:
+            side *= np.float32(high_gain)
+
+        # Decode: L = M + S', R = M - S'
+        np.subtract(l, side, out=r)
+        l += side
+
+    if split and state is not None:
+        state["side_hp"] = zi
+    return buffer
+
+
+def apply_ms_tonal_balance(buffer, sample_rate, side_gain_db=2.0, side_hp=500):
+    return apply_mid_side(buffer, sample_rate, side_gain_db=side_gain_db, side_hp=side_hp)
+
+
+def apply_safe_width(buffer, width_factor=1.0):
+    """
+    width_factor: 1.0 is original, >1,0 is wider, <1.0 is narrower.
+    Only the side channel is scaled so the mono sum never changes.
+    """
+    return apply_mid_side(buffer, None, width_factor=width_factor, side_hp=None, low_side_gain=1.0)
+
+
+# --- Dynamics ---
+def apply_gain(buffer, gain_db):
+    buffer *= np.float32(db_to_gain(gain_db))
+    return buffer
+
+
+def apply_limiter(buffer, sample_rate, ceiling=-1.0):
+    # Look-ahead true-peak limiter, only touches the frames around overs
+    import dynamics
+    return dynamics.apply_true_peak_limiter(buffer, sample_rate, ceiling=ceiling)
+
+
+def apply_multiband(buffer, sample_rate, settings=None):
+    # settings: MultibandCompressor keyword arguments (crossovers, threshold_db, ratio, ...)
+    import dynamics
+    return dynamics.apply_multiband_compressor(buffer, sample_rate, **(settings or {}))
+
+
+def apply_soft_clip(buffer, drive_db=3.0, oversample=4):
+    # tanh saturation, oversampled so the added harmonics don't alias (oversample=1: native rate)
+    import dynamics
+    return dynamics.apply_soft_clip(buffer, drive_db=drive_db, oversample=oversample)
+
+
+# --- Loudness ---
+def measure_loudness(buffer, sample_rate):
+    import analysis
+    return analysis.integrated_loudness(buffer, sample_rate)
+
+
+def match_target_lufs(buffer, sample_rate, target_lufs=-14.0, ceiling=-1.0):
+    current_lufs = measure_loudness(buffer, sample_rate)
+    apply_gain(buffer, target_lufs - current_lufs)
+    return apply_limiter(buffer, sample_rate, ceiling=ceiling)
+
+
+def report_analysis(report):
+    lufs = report["integrated_lufs"]
+    print(f"Loudness: {lufs:.2f} LUFS | LRA {report['loudness_range_lu']:.1f} LU | "
+          f"True Peak {report['true_peak_dbtp']:.2f} dBTP | Phase {report['phase_correlation']:.2f}")
+    if lufs < -16:
+        print("Note: This track might be a bit quiet for streaming (-14 LUFs is the target).")
+    elif lufs > -9:
+        print("Note: This track is very loud/compressed (Club/EDM levels).")
+
+    phase_drop = report["mono_drop_db"]
+    if phase_drop > 3.0:
+        print(f"⚠️Warning: Large phase drop ({phase_drop:.2f} dB). Your master might sound 'hollow' in mono.")
+
+
+# --- Fades & Dither ---
+def apply_fades(buffer, sample_rate, fade_ms=50):
+    fade_len = min(int(sample_rate * fade_ms / 1000.0), len(buffer))
+    if fade_len <= 0:
+        return buffer
+
+    ramp = np.linspace(0.0, 1.0, fade_len, endpoint=False, dtype=np.float32)[:, None]
+    buffer[:fade_len] *= ramp
+    buffer[-fade_len:] *= ramp[::-1]
+    return buffer
+
+
+# --- Chain ---
+def render_filters(buffer, sample_rate, hp_cutoff=40, lp_cutoff=15000, profiler=None, eq_bands=None,
+                   eq_phase="linear"):
+    """
+    First half of the chain: the static EQ. Its output only depends on the snip,
+    the cutoffs and the parametric bands (one FIR pass, see eq.py).
+    """
+    import eq
+    import profiler as prof
+
+    print(f"Applying Filters ...")
+    with prof.stage(profiler, "high_pass", buffer):
+        apply_high_pass(buffer, sample_rate, hp_cutoff)
+    with prof.stage(profiler, "low_pass", buffer):
+        apply_low_pass(buffer, sample_rate, lp_cutoff)
+    with prof.stage(profiler, "tilt_eq", buffer):
+        apply_til_eq(buffer, sample_rate, tilt_amount=1.0)
+    if eq_bands:
+        print(f"Applying Parametric EQ ({len(eq_bands)} bands, {eq_phase} phase)...")
+        with prof.stage(profiler, "parametric_eq", buffer):
+            eq.apply_eq(buffer, sample_rate, eq_bands, phase=eq_phase)
+    return buffer
+
+
+def render_finish(buffer, sample_rate, use_clipper=False, stereo_width=1.0, fade_ms=50, profiler=None,
+                  clip_oversample=4, multiband=None, target_lufs=-14.0):
+    """
+    Second half of the chain: M/S, multiband compression (when `multiband` is
+    True or a dict of settings), loudness (to target_lufs), clipping and fades.
+    Dither is added when the buffer is quantized at export.
+    Returns the buffer and the analysis report of the final master.
+    """
+    import analysis
+    import profiler as prof
+
+    # Tonal balance and width share a single M/S encode/decode pass
+    print(f"Applying Mid-Side Processing & phase-safe Stereo Widening ({stereo_width}x)...")
+    with prof.stage(profiler, "mid_side", buffer):
+        apply_mid_side(buffer, sample_rate, side_gain_db=0.7, width_factor=stereo_width)
+
+    if multiband:
+        print("Applying Multiband Compression...")
+        with prof.stage(profiler, "multiband", buffer):
+            apply_multiband(buffer, sample_rate, multiband if isinstance(multiband, dict) else None)
+
+    print(f"Targeting {target_lufs:g} LUFs & Limiting...")
+    with prof.stage(profiler, "loudness_match", buffer):
+        match_target_lufs(buffer, sample_rate, target_lufs=target_lufs, ceiling=-1.0)
+
+    if use_clipper:
+        print(f"Applying Soft Clipping (Warmth, {clip_oversample}x oversampled)...")
+        with prof.stage(profiler, "soft_clip", buffer):
+            apply_soft_clip(buffer, oversample=clip_oversample)
+        with prof.stage(profiler, "limiter", buffer):
+            apply_limiter(buffer, sample_rate, ceiling=-1.0)
+    # The clean path ends at the loudness limiter: normalizing its output to
+    # -0.1 dBFS sample peak would throw away both the LUFS target and the ceiling
+
+    print(f"Applying {fade_ms}ms Fades...")
+    with prof.stage(profiler, "fades", buffer):
+        apply_fades(buffer, sample_rate, fade_ms)
+
+    # One pass for loudness, LRA, true peak, phase and mono-sum drop
+    with prof.stage(profiler, "analysis", buffer):
+        report = analysis.analyze(buffer, sample_rate)
+    report_analysis(report)
+    return buffer, report
@@ -0,0 +1,211 @@
+import functools
+import numpy as np
+from scipy import fft
+from scipy.signal import butter, sosfreqz
+
+import engine
+
+# Parametric EQ as a single FIR. Every band in the list is designed as an RBJ
+# cookbook biquad (or a Butterworth cascade for HP/LP), the magnitudes are
+# multiplied on a dense frequency grid, and the combined response is turned
+# into one linear- or minimum-phase kernel. That kernel is applied with FFT
+# overlap-add, so the cost is one convolution pass whatever the band count.
+# Kernels (and their spectra) are cached per sample rate and band set.
+#
+# A band is a dict:
+#   {"type": "bell", "freq": 3000, "gain_db": -2.0, "q": 1.4}
+#   {"type": "low_shelf" | "high_shelf", "freq": 120, "gain_db": 1.5, "q": 0.707}
+#   {"type": "high_pass" | "low_pass", "freq": 30, "slope": 24}   (dB/oct, multiple of 6)
+
+BAND_TYPES = ("bell", "low_shelf", "high_shelf", "high_pass", "low_pass")
+EQ_BLOCK_FRAMES = 65536
+EQ_MIN_TAPS = 1025
+EQ_MAX_TAPS = 32769
+# Kernel length in periods of a band's frequency, scaled up for narrow bands
+# (Q above 1) and steep HP/LP slopes, whose responses ring for longer
+EQ_TAPS_PER_PERIOD = 8
+# Designed kernels must match the bands to this, from EQ_CHECK_LOW_HZ up and
+# wherever the target is above EQ_CHECK_FLOOR (-60 dB)
+EQ_TOLERANCE_DB = 0.1
+EQ_CHECK_LOW_HZ = 20.0
+EQ_CHECK_FLOOR = 1e-3
+
+
+# --- Band Design ---
+def _rbj_sos(band, sample_rate):
+    # RBJ audio-EQ-cookbook biquads
+    A = 10 ** (band.get("gain_db", 0.0) / 40.0)
+    w0 = 2 * np.pi * band["freq"] / sample_rate
+    alpha = np.sin(w0) / (2 * band.get("q", 1.0 if band["type"] == "bell" else 1 / np.sqrt(2)))
+    cos_w0 = np.cos(w0)
+
+    if band["type"] == "bell":
+        b = [1 + alpha * A, -2 * cos_w0, 1 - alpha * A]
+        a = [1 + alpha / A, -2 * cos_w0, 1 - alpha / A]
+    else:
+        sqrt_a = 2 * np.sqrt(A) * alpha
+        sign = 1 if band["type"] == "low_shelf" else -1
+        b = [A * ((A + 1) - sign * (A - 1) * cos_w0 + sqrt_a),
+             sign * 2 * A * ((A - 1) - sign * (A + 1) * cos_w0),
+             A * ((A + 1) - sign * (A - 1) * cos_w0 - sqrt_a)]
+        a = [(A + 1) + sign * (A - 1) * cos_w0 + sqrt_a,
+             -sign * 2 * ((A - 1) + sign * (A + 1) * cos_w0),
+             (A + 1) + sign * (A - 1) * cos_w0 - sqrt_a]
+    return np.array([b + a]) / a[0]
+
+
+def band_sos(band, sample_rate):
+    """Second-order sections for one band dict."""
+    kind = band["type"]
+    if kind not in BAND_TYPES:
+        raise ValueError(f"Unknown EQ band type {kind!r}, expected one of {BAND_TYPES}")
+    if kind in ("high_pass", "low_pass"):
+        slope = band.get("slope", 12)
+        if slope % 6 or slope <= 0:
+            raise ValueError("HP/LP slope must be a positive multiple of 6 dB/oct")
+        return butter(slope // 6, band["freq"], btype="high" if kind == "high_pass" else "low",
+                      fs=sample_rate, output="sos")
+    return _rbj_sos(band, sample_rate)
+
+
+def response(bands, sample_rate, freqs):
+    """Combined magnitude of all bands at `freqs` (Hz)."""
+    magnitude = np.ones(len(freqs))
+    for band in bands:
+        _, h = sosfreqz(band_sos(band, sample_rate), worN=freqs, fs=sample_rate)
+        magnitude *= np.abs(h)
+    return magnitude
+
+
+def _bands_key(bands):
+    # Hashable, order-independent form of a band list for the kernel cache
+    return tuple(sorted(tuple(sorted(band.items())) for band in bands))
+
+
+# --- Kernel Design ---
+def _band_periods(band):
+    if band["type"] in ("high_pass", "low_pass"):
+        return EQ_TAPS_PER_PERIOD * max(1.0, band.get("slope", 12) / 12.0)
+    return EQ_TAPS_PER_PERIOD * max(1.0, band.get("q", 1.0))
+
+
+def kernel_taps(bands, sample_rate):
+    """Long enough for the band that needs the most frames, within EQ_MIN/MAX_TAPS."""
+    taps = max(int(_band_periods(band) * sample_rate / max(band["freq"], 1.0)) for band in bands)
+    taps = min(EQ_MAX_TAPS, max(EQ_MIN_TAPS, taps))
+    return taps | 1
+
+
+def _shape_kernel(magnitude, taps, n_fft, phase):
+    if phase == "linear":
+        # Zero-phase impulse, centred and windowed: symmetric, delay of taps // 2
+        h = np.fft.irfft(magnitude, n_fft)
+        return np.roll(h, taps // 2)[:taps] * np.hanning(taps + 2)[1:-1]
+    if phase == "minimum":
+        # Homomorphic (real cepstrum) minimum phase, tapered with a half window
+        cepstrum = np.fft.irfft(np.log(np.maximum(magnitude, 1e-9)), n_fft)
+        cepstrum[1:n_fft // 2] *= 2
+        cepstrum[n_fft // 2 + 1:] = 0
+        h = np.fft.irfft(np.exp(np.fft.rfft(cepstrum)), n_fft)
+        return h[:taps] * np.hanning(2 * taps + 1)[taps:-1]
+    raise ValueError(f"phase must be 'linear' or 'minimum', not {phase!r}")
+
+
+def _kernel_error_db(kernel, magnitude, freqs, n_fft):
+    # Worst deviation from the target response where it's audible; deep
+    # HP/LP stopbands would otherwise decide the length
+    actual = np.abs(np.fft.rfft(kernel, n_fft))
+    audible = (freqs >= EQ_CHECK_LOW_HZ) & (magnitude > EQ_CHECK_FLOOR)
+    if not np.any(audible):
+        return 0.0
+    return float(np.max(np.abs(20 * np.log10(np.maximum(actual[audible], 1e-12) / magnitude[audible]))))
+
+
+@functools.lru_cache(maxsize=64)
+def _design(sample_rate, bands_key, phase):
+    bands = [dict(band) for band in bands_key]
+    taps = kernel_taps(bands, sample_rate)
+    # The estimate is a starting point: grow the kernel until it matches the
+    # bands to within EQ_TOLERANCE_DB, or EQ_MAX_TAPS is reached
+    while True:
+        n_fft = fft.next_fast_len(8 * taps)
+        freqs = np.fft.rfftfreq(n_fft, 1.0 / sample_rate)
+        magnitude = response(bands, sample_rate, freqs)
+        kernel = _shape_kernel(magnitude, taps, n_fft, phase)
+        if taps >= EQ_MAX_TAPS or _kernel_error_db(kernel, magnitude, freqs, n_fft) <= EQ_TOLERANCE_DB:
+            break
+        taps = min(EQ_MAX_TAPS, 2 * taps) | 1
+
+    kernel = kernel.astype(np.float32)
+    kernel.flags.writeable = False
+    return kernel
+
+
+def design_kernel(bands, sample_rate, phase="linear"):
+    """The combined FIR for a band list (cached). Linear phase delays by len // 2 frames."""
+    return _design(int(sample_rate), _bands_key(bands), phase)
+
+
+@functools.lru_cache(maxsize=64)
+def _kernel_spectrum(sample_rate, bands_key, phase, n_fft):
+    kernel = _design(sample_rate, bands_key, phase)
+    spectrum = fft.rfft(kernel, n_fft)
+    spectrum.flags.writeable = False
+    return spectrum
+
+
+# --- Overlap-Add ---
+class ParametricEQ:
+    """
+    Streams audio through the combined EQ kernel with FFT overlap-add. The
+    linear-phase delay is removed: like the limiter, output lags input inside
+    process() and flush() returns the rest, so every frame comes out once and
+    in place.
+    """
+
+    def __init__(self, bands, sample_rate, channels, phase="linear", block_frames=EQ_BLOCK_FRAMES):
+        key = _bands_key(bands)
+        self.kernel = _design(int(sample_rate), key, phase)
+        self.block_frames = block_frames
+        self.n_fft = fft.next_fast_len(block_frames + len(self.kernel) - 1, real=True)
+        self.spectrum = _kernel_spectrum(int(sample_rate), key, phase, self.n_fft)[:, None]
+        self.channels = channels
+        self.delay = len(self.kernel) // 2 if phase == "linear" else 0
+
+        self._tail = np.zeros((len(self.kernel) - 1, channels), dtype=np.float32)
+        self._skip = self.delay
+
+    def _convolve(self, chunk):
+        n = len(chunk)
+        y = fft.irfft(fft.rfft(chunk, self.n_fft, axis=0) * self.spectrum, self.n_fft, axis=0)
+        y = y[:n + len(self._tail)]
+        y[:len(self._tail)] += self._tail
+        self._tail = y[n:].copy()
+        return y[:n]
+
+    def process(self, block):
+        outputs = []
+        for pos in range(0, len(block), self.block_frames):
+            out = self._convolve(block[pos:pos + self.block_frames])
+            if self._skip:
+                drop = min(self._skip, len(out))
+                out = out[drop:]
+                self._skip -= drop
+            outputs.append(out)
+        if not outputs:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        return (np.concatenate(outputs) if len(outputs) > 1 else outputs[0]).astype(np.float32, copy=False)
+
+    def flush(self):
+        # Push the delayed frames out with silence
+        if not self.delay:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        return self.process(np.zeros((self.delay, self.channels), dtype=np.float32))
+
+
+def apply_eq(buffer, sample_rate, bands, phase="linear"):
+    """Applies a band list to a whole float32 buffer in place, block by block."""
+    if not bands or not len(buffer):
+        return buffer
+    equalizer = ParametricEQ(bands, sample_rate, buffer.shape[1], phase=phase)
+    return engine.process_in_place(equalizer, buffer, EQ_BLOCK_FRAMES)
@@ -0,0 +1,278 @@
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import time
+
+import engine
+import wavio
+
+# Deliverables: one final float32 buffer written out as several files at once
+# (e.g. 24-bit WAV + FLAC + MP3). Each output gets its own writer, and every
+# writer hashes the exact bytes it puts on disk as it writes them, so nothing is
+# read back afterwards. WAV goes through wavio directly; other formats are piped
+# through their own ffmpeg process, so the encoders run side by side. The
+# hashes end up in a sidecar manifest next to the primary output.
+# The exception is formats whose muxer goes back and rewrites its header once
+# the stream ends (FLAC's sample count and MD5, MP3's Xing frame count, MP4's
+# moov atom): ffmpeg writes those to the file itself so it can seek, and the
+# finished file is hashed afterwards in 1 MiB chunks.
+#
+# A deliverable is a format name ("flac") or a dict:
+#   {"format": "mp3", "bitrate": "320k"}
+#   {"format": "wav", "sample_width": 3, "path": "masters/song_24.wav"}
+# sample_width defaults to the master's width (FLAC tops out at 24-bit, lossy
+# encoders are fed 32-bit); path defaults to the primary output's name with
+# the format's extension.
+
+HASH_CHUNK_BYTES = 1 << 20
+PCM_FORMATS = {2: "s16le", 3: "s24le", 4: "s32le"}
+FLAC_MAX_WIDTH = 3
+EXTENSIONS = {"aac": "m4a", "opus": "opus", "vorbis": "ogg"}
+# Codec names that aren't ffmpeg muxers: AAC goes in an MP4 (.m4a) container,
+# Vorbis in Ogg. Everything else is passed to -f as given
+MUXERS = {"aac": ("ipod", "aac"), "vorbis": ("ogg", "libvorbis")}
+SEEKABLE_FORMATS = ("flac", "mp3", "mp4", "ipod", "mov")
+
+
+# --- Writers ---
+class HashingWavWriter(wavio.WavWriter):
+    """wavio.WavWriter that hashes the file as it is written. `frames` must be known up front."""
+
+    def __init__(self, path, sample_rate, channels, sample_width=2, frames=None, tags=None, dither=None):
+        if frames is None:
+            raise ValueError("hash-on-write needs the frame count before the header is written")
+        self._hash = hashlib.sha256()
+        self.bytes = 0
+        super().__init__(path, sample_rate, channels, sample_width, frames=frames, tags=tags, dither=dither)
+
+    def _emit(self, data):
+        self._hash.update(data)
+        self.bytes += len(data)
+        self._file.write(data)
+
+    def close(self):
+        # A patched header would no longer match the running hash
+        mismatch = self._file is not None and self.written != self.frames
+        super().close()
+        if mismatch:
+            raise RuntimeError(f"{self.path}: wrote {self.written} frames, header said {self.frames}")
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+
+class FfmpegPipeWriter:
+    """
+    Feeds PCM to ffmpeg's stdin and takes the encoded file from its stdout,
+    so the bytes can be hashed on their way to disk. A drain thread keeps
+    stdout moving while we write, otherwise both pipes could fill up.
+    seekable=True lets ffmpeg write the file itself instead, for formats in
+    SEEKABLE_FORMATS; the file is then hashed once it is closed.
+    """
+
+    def __init__(self, path, sample_rate, channels, sample_width, export_format, tags=None, dither=None,
+                 codec_args=(), seekable=False):
+        self.path = path
+        self.sample_width = sample_width
+        self.dither = dither
+        self.bytes = 0
+        self._hash = hashlib.sha256()
+        self._sha256 = None
+        cmd = ["ffmpeg", "-v", "error", "-y", "-f", PCM_FORMATS[sample_width], "-ar", str(sample_rate),
+               "-ac", str(channels), "-i", "-"]
+        for key, value in (tags or {}).items():
+            cmd += ["-metadata", f"{key}={value}"]
+        cmd += list(codec_args) + ["-f", export_format, path if seekable else "pipe:1"]
+        self._drain_error = None
+        if seekable:
+            self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            self._file = None
+            self._drain = None
+            return
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._file = open(path, "wb")
+        self._drain = threading.Thread(target=self._drain_stdout, daemon=True)
+        self._drain.start()
+
+    def _drain_stdout(self):
+        try:
+            for chunk in iter(lambda: self._proc.stdout.read(HASH_CHUNK_BYTES), b""):
+                self._hash.update(chunk)
+                self._file.write(chunk)
+                self.bytes += len(chunk)
+        except Exception as e:
+            self._drain_error = e
+
+    def write(self, block):
+        self._proc.stdin.write(wavio.encode_pcm(block, self.sample_width, self.dither))
+
+    def close(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg already gave up; its exit code says why
+            pass
+        if self._drain is not None:
+            self._drain.join()
+            self._file.close()
+        code = self._proc.wait()
+        self._proc = None
+        if code != 0 or self._drain_error is not None:
+            raise RuntimeError(f"ffmpeg failed to encode {self.path}: {self._drain_error or f'exit code {code}'}")
+        if self._drain is None:
+            # ffmpeg has patched the header, so only now are the bytes final
+            import main
+            self._sha256 = main.generate_file_hash(self.path)
+            self.bytes = os.path.getsize(self.path)
+
+    @property
+    def sha256(self):
+        return self._sha256 or self._hash.hexdigest()
+
+
+def _codec_args(spec):
+    args = []
+    if spec["format"] in MUXERS:
+        args += ["-c:a", MUXERS[spec["format"]][1]]
+    if spec.get("bitrate"):
+        args += ["-b:a", str(spec["bitrate"])]
+    return args
+
+
+def open_writer(spec, sample_rate, channels, frames, tags=None, dither="auto"):
+    """A hashing writer for one resolved deliverable. `dither` is an engine dither setting."""
+    width = spec["sample_width"]
+    if spec["format"] == "wav":
+        return HashingWavWriter(spec["path"], sample_rate, channels, width, frames=frames, tags=tags,
+                                dither=engine.make_dither(dither, width))
+    muxer = MUXERS.get(spec["format"], (spec["format"],))[0]
+    return FfmpegPipeWriter(spec["path"], sample_rate, channels, width, muxer, tags,
+                            engine.make_dither(dither, width), _codec_args(spec),
+                            seekable=muxer in SEEKABLE_FORMATS)
+
+
+def _record(spec, writer):
+    return {"path": spec["path"], "format": spec["format"], "sample_width": spec["sample_width"],
+            "bytes": writer.bytes, "sha256": writer.sha256}
+
+
+# --- Deliverables ---
+def resolve_deliverables(output_file, export_format, sample_width, deliverables=None):
+    """
+    The primary output followed by every extra deliverable, each as a full
+    spec dict with format, sample_width and a path no other output uses.
+    """
+    base = os.path.splitext(output_file)[0]
+    specs = [{"format": export_format, "path": output_file}] + [
+        {"format": d} if isinstance(d, str) else dict(d) for d in deliverables or []]
+    used = set()
+    for spec in specs:
+        fmt = spec["format"]
+        if "sample_width" not in spec:
+            if fmt == "wav":
+                spec["sample_width"] = sample_width
+            elif fmt == "flac":
+                spec["sample_width"] = min(max(sample_width, 2), FLAC_MAX_WIDTH)
+            else:
+                spec["sample_width"] = 4
+        # 8-bit only exists as WAV; everything else goes through ffmpeg's PCM input
+        allowed = (1, 2, 3, 4) if fmt == "wav" else tuple(PCM_FORMATS)
+        if spec["sample_width"] not in allowed:
+            raise ValueError(f"{fmt}: sample_width must be one of {allowed}, not {spec['sample_width']}")
+        if "path" not in spec:
+            spec["path"] = f"{base}.{EXTENSIONS.get(fmt, fmt)}"
+            if spec["path"] in used:
+                spec["path"] = f"{base}_{8 * spec['sample_width']}bit.{EXTENSIONS.get(fmt, fmt)}"
+        if spec["path"] in used:
+            raise ValueError(f"two deliverables would both write {spec['path']}")
+        used.add(spec["path"])
+    return specs
+
+
+def _export_one(buffer, sample_rate, spec, tags, dither):
+    started = time.perf_counter()
+    writer = open_writer(spec, sample_rate, buffer.shape[1], len(buffer), tags, dither)
+    try:
+        for pos in range(0, len(buffer), wavio.CONVERT_BLOCK_FRAMES):
+            writer.write(buffer[pos:pos + wavio.CONVERT_BLOCK_FRAMES])
+    finally:
+        writer.close()
+    return dict(_record(spec, writer), encode_sec=time.perf_counter() - started)
+
+
+def export_buffer(buffer, sample_rate, specs, tags=None, dither="auto"):
+    """
+    Writes a float32 buffer to every resolved spec concurrently, one thread
+    per output. The buffer is only read. Returns one record per spec, in order.
+    """
+    if len(specs) == 1:
+        return [_export_one(buffer, sample_rate, specs[0], tags, dither)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(specs)) as pool:
+        futures = [pool.submit(_export_one, buffer, sample_rate, spec, tags, dither) for spec in specs]
+        return [future.result() for future in futures]
+
+
+class MultiWriter:
+    """
+    Block-by-block fan-out to every spec, for the streaming renderer. The
+    ffmpeg encoders still run in parallel in their own processes.
+    """
+
+    def __init__(self, specs, sample_rate, channels, frames, tags=None, dither="auto"):
+        self.specs = specs
+        self.writers = []
+        try:
+            for spec in specs:
+                self.writers.append(open_writer(spec, sample_rate, channels, frames, tags, dither))
+        except Exception:
+            self.close()
+            raise
+
+    def write(self, block):
+        for writer in self.writers:
+            writer.write(block)
+
+    def close(self):
+        errors = []
+        for writer in self.writers:
+            try:
+                writer.close()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def records(self):
+        return [_record(spec, writer) for spec, writer in zip(self.specs, self.writers)]
+
+
+# --- Manifest ---
+def manifest_path(output_file):
+    return os.path.splitext(output_file)[0] + "_manifest.json"
+
+
+def write_manifest(output_file, records, source=None, report=None):
+    """Sidecar JSON listing every deliverable with its size and SHA-256."""
+    path = manifest_path(output_file)
+    manifest = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "source": source or {},
+        "loudness": None if report is None else {
+            "integrated_lufs": report["integrated_lufs"],
+            "true_peak_dbtp": report["true_peak_dbtp"],
+            "loudness_range_lu": report["loudness_range_lu"],
+        },
+        "deliverables": records,
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+    return path
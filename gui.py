@@ -1,17 +1,26 @@
 import tkinter as tk
-from threading import Thread
 from tkinter import filedialog, messagebox, ttk
-import  main
-import threading
 import os
+import time
+import cache
+import jobs
+# Loaded up front so forked render workers start with the engine already imported
+import main
+
+POLL_MS = 100
 
 class MasteringApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Ashan's Python Audio Mastering Tool v1.1")
-        self.root.geometry("450x550")
+        self.root.geometry("520x760")
         self.root.configure(bg="#1e1e1e")
 
+        # Renders run in worker processes; re-renders with the same settings (or
+        # only new width/clipper) come from the cache they share
+        self.job_queue = jobs.JobQueue(cache_dir=cache.DEFAULT_CACHE_DIR)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
         # Custom styling
         style = ttk.Style()
         style.theme_use('clam')
@@ -62,92 +71,143 @@ class MasteringApp:
         self.width_slider.grid(row=3, column=1, columnspan=2, sticky="ew", pady=5)
 
         # Progress and Action
-        self.master_btn = tk.Button(root, text="RENDER MASTER", bg="#d79921", fg="black",
+        self.master_btn = tk.Button(root, text="QUEUE MASTER", bg="#d79921", fg="black",
                                     font=("Arial", 12, "bold"), height=2, command=self.run_mastering)
         self.master_btn.pack(pady=15, padx=20, fill="x")
 
+        # Job List (one row per queued render)
+        tk.Label(root, text="RENDER QUEUE", bg="#1e1e1e", fg="gray", font=("Arial", 8)).pack()
+        self.job_list = ttk.Treeview(root, columns=("file", "status", "stage", "time"), show="headings", height=6)
+        for column, width in (("file", 200), ("status", 80), ("stage", 120), ("time", 60)):
+            self.job_list.heading(column, text=column.upper())
+            self.job_list.column(column, width=width, anchor="w")
+        self.job_list.pack(pady=5, padx=20, fill="x")
+        tk.Button(root, text="Cancel Selected", command=self.cancel_selected, bg="#cc241d", fg="white").pack(pady=5)
+
         # Log Box (Console Feedback)
         tk.Label(root, text="PROCESS LOG", bg="#1e1e1e", fg="gray", font=("Arial", 8)).pack()
-        self.log_box = tk.Text(root, height=6, bg="#000000", fg="#00ff00", font=("Consolas", 9))
+        self.log_box = tk.Text(root, height=8, bg="#000000", fg="#00ff00", font=("Consolas", 9))
         self.log_box.pack(pady=5, padx=20, fill="x")
+
+        self.root.after(POLL_MS, self.poll_jobs)
+
     def log(self, message):
         self.log_box.insert(tk.END, f"> {message}\n")
         self.log_box.see(tk.END)
 
     def browse_file(self):
-        filename = filedialog.askopenfilename(filetypes=[("Audio Files", "*.wav *.mp3 *.flac")])
-        if filename:
-            self.input_path.set(filename)
-            self.log(f"Loaded: {os.path.basename(filename)}")
+        filenames = filedialog.askopenfilenames(filetypes=[("Audio Files", "*.wav *.mp3 *.flac")])
+        if filenames:
+            # Several files queue one render each
+            self.input_path.set("; ".join(filenames))
+            self.log(f"Loaded: {', '.join(os.path.basename(f) for f in filenames)}")
 
     def show_success(self, output_file):
         messagebox.showinfo("Success", f"Mastering Complete!\nSaved as {output_file}")
 
     def run_mastering(self):
-        if not self.input_path.get():
+        input_files = [f.strip() for f in self.input_path.get().split(";") if f.strip()]
+        if not input_files:
             messagebox.showerror("Error", "Please select a file first")
             return
 
+        try:
+            # Gather UI data
+            start = float(self.start_entry.get() or 0)
+            end = float(self.end_entry.get() or 0)
+            hp = int(self.hp_entry.get() or 0)
+            lp = int(self.lp_entry.get() or 0)
+        except ValueError:
+            self.log("ERROR: Please use numbers only in the settings.")
+            messagebox.showerror("Input Error", "Invalid numbers in EQ or Snipping fields ")
+            return
 
-        def task():
-            self.master_btn.config(state="disabled", text="PROCESSING...")
-            self.log("Initializing engine...")
-            try:
-                # Gather UI data
-                start = float(self.start_entry.get() or 0)
-                end = float(self.end_entry.get() or 0)
-                hp = int(self.hp_entry.get() or 0)
-                lp = int(self.lp_entry.get() or 0)
-
-                stereo_w = float(self.width_slider.get())
-                clipper_status = self.use_clipper.get()
-
-                input_file = self.input_path.get()
-                output_file = f"mastered_{os.path.basename(input_file)}"
-
-                self.log(f"Snipping: {start}s to {end}s")
-                self.log(f"EQ: HP {hp}Hz | LP {lp}Hz")
-                self.log(f"Stereo Width: {stereo_w}x")
-
-                # Execute engine
-                main.snip_audio(input_file, start, end,output_file,
-                                use_clipper=clipper_status,
-                                hp_cutoff=hp,
-                                lp_cutoff=lp,
-                                stereo_width=stereo_w)
-
-                # --- Phase analysis block ---
-                self.log("Analyzing phase correlation...")
-                from pydub import AudioSegment
-
-                check_audio = AudioSegment.from_file(output_file)
-                phase_val = main.calculate_phase_correlation(check_audio)
-
-                self.log(f"Phase Correlation: {phase_val:.2f}")
-                if phase_val < 0:
-                    self.log(" CRITICAL: Phase is negative! Mono-sum will cancel out.")
-                elif phase_val < 0.3:
-                    self.log(" WARNING: Very wide stereo. Check mono compatibility")
-                else:
-                    self.log(" Phase is healthy.")
-
-                # ----------------------------------------------------------------------
-
-                self.log("Generating visual analysis...")
-                self.log(f"SUCCESS {output_file}")
-                self.root.after(0, lambda f=output_file: self.show_success(f))
-
-            except ValueError:
-                self.log("ERROR: Please use numbers only in the settings.")
-                messagebox.showerror("Input Error", "Invalid numbers in EQ or Snipping fields ")
-                return  # Stop the task here
-            except Exception as e:
-                self.log(f"ERROR: {str(e)}")
-                self.root.after(0, lambda err=e: messagebox.showerror("Mastering Error", str(err)))
-            finally:
-                self.master_btn.config(state="normal", text="RENDER MASTER")
-
-        threading.Thread(target=task, daemon=True).start()
+        stereo_w = float(self.width_slider.get())
+        clipper_status = self.use_clipper.get()
+
+        self.log(f"Snipping: {start}s to {end}s")
+        self.log(f"EQ: HP {hp}Hz | LP {lp}Hz")
+        self.log(f"Stereo Width: {stereo_w}x")
+        for input_file in input_files:
+            output_file = f"mastered_{os.path.basename(input_file)}"
+            job_id = self.job_queue.submit(input_file, start, end, output_file,
+                                           use_clipper=clipper_status,
+                                           hp_cutoff=hp,
+                                           lp_cutoff=lp,
+                                           stereo_width=stereo_w)
+            self.job_list.insert("", tk.END, iid=str(job_id),
+                                 values=(os.path.basename(input_file), jobs.QUEUED, "", ""))
+            self.log(f"Queued #{job_id}: {os.path.basename(input_file)}")
+
+    def cancel_selected(self):
+        for iid in self.job_list.selection():
+            if self.job_queue.cancel(int(iid)):
+                self.log(f"Cancelled #{iid}")
+                self.update_row(int(iid))
+
+    # --- Job Events ---
+    def update_row(self, job_id):
+        job = self.job_queue.jobs[job_id]
+        elapsed = ""
+        if "started" in job:
+            elapsed = f"{job.get('finished', time.time()) - job['started']:.1f}s"
+        self.job_list.item(str(job_id), values=(os.path.basename(job["input"]), job["status"], job["stage"] or "",
+                                                elapsed))
+
+    def poll_jobs(self):
+        # Runs on the Tk thread; the workers only ever talk to the queue
+        for event in self.job_queue.poll():
+            job_id = event["job"]
+            if event["type"] == "done":
+                self.report_result(job_id, event["result"], event.get("cache_stats"))
+            elif event["type"] == "error":
+                self.log(f"ERROR #{job_id}: {event['error']}")
+                messagebox.showerror("Mastering Error", event["error"])
+            self.update_row(job_id)
+
+        for job_id, job in self.job_queue.jobs.items():
+            if job["status"] == jobs.RUNNING:
+                self.update_row(job_id)
+        self.root.after(POLL_MS, self.poll_jobs)
+
+    def report_result(self, job_id, result, stats=None):
+        output_file = result["output_file"]
+        if stats is not None:
+            self.log(f"Cache: {stats['render']['hits']} render hits / {stats['render']['misses']} misses, "
+                     f"{stats['bytes'] / 2**20:.0f} MB used")
+
+        # --- Phase analysis block ---
+        # Comes from the engine's single analysis pass, no re-decode of the output
+        report = result["analysis"]
+        phase_val = report["phase_correlation"]
+
+        self.log(f"Loudness: {report['integrated_lufs']:.2f} LUFS | LRA {report['loudness_range_lu']:.1f} LU "
+                 f"| True Peak {report['true_peak_dbtp']:.2f} dBTP")
+        self.log(f"Mono-sum drop: {report['mono_drop_db']:.2f} dB")
+        self.log(f"Phase Correlation: {phase_val:.2f}")
+        if phase_val < 0:
+            self.log(" CRITICAL: Phase is negative! Mono-sum will cancel out.")
+        elif phase_val < 0.3:
+            self.log(" WARNING: Very wide stereo. Check mono compatibility")
+        else:
+            self.log(" Phase is healthy.")
+
+        # ----------------------------------------------------------------------
+
+        # --- Stage timings ---
+        timing = result["timing"]
+        slowest = sorted(timing["stages"], key=lambda s: s["wall_sec"], reverse=True)[:3]
+        self.log(f"Render: {timing['total_wall_sec']:.2f}s | slowest: "
+                 + ", ".join(f"{s['stage']} {s['wall_sec']:.2f}s" for s in slowest))
+
+        self.log(f"SUCCESS #{job_id} {output_file}")
+        if not self.job_queue.active:
+            self.show_success(output_file)
+
+    def on_close(self):
+        # Kill whatever is still rendering so no worker outlives the window
+        self.job_queue.shutdown()
+        self.root.destroy()
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,209 @@
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import sys
+import time
+
+# Render job queue for the GUI (or anything else with an event loop). Every
+# job runs snip_audio in its own process, so heavy DSP never holds the caller's
+# GIL, and up to `workers` jobs run at once. Each worker reports back through
+# its own pipe as plain dict events, so killing one job can't leave a shared
+# channel half-written for the others. The owner drains them with poll() from
+# its own loop (the GUI does it from root.after), so nothing but the owner ever
+# touches its state. Event types:
+#   started / log (a line the engine printed) / stage (a profiler record) /
+#   done (the result summary and cache stats) / error
+
+QUEUED, RUNNING, DONE, ERROR, CANCELLED = "queued", "running", "done", "error", "cancelled"
+POLL_MAX_EVENTS = 500
+
+
+# --- Worker ---
+class _EventStream:
+    """Stands in for sys.stdout in a worker and turns each printed line into a log event."""
+
+    def __init__(self, job_id, send):
+        self.job_id = job_id
+        self.send = send
+        self._partial = ""
+
+    def write(self, text):
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            if line.strip():
+                self.send({"job": self.job_id, "type": "log", "message": line})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def summarize(result):
+    # Only the JSON-able part crosses the process boundary
+    return {key: result[key] for key in ("output_file", "sha256", "duration_sec", "lufs", "analysis",
+                                         "analysis_image", "timing") if key in result}
+
+
+def _run_job(job_id, job, conn, cache_dir):
+    import main
+    import profiler as prof
+
+    send = conn.send
+    sys.stdout = _EventStream(job_id, send)
+    send({"job": job_id, "type": "started", "pid": os.getpid()})
+    started = time.perf_counter()
+    try:
+        render_cache = None
+        if cache_dir is not None:
+            import cache
+            render_cache = cache.RenderCache(cache_dir)
+        profiler = prof.RenderProfiler(callback=lambda record: send({"job": job_id, "type": "stage", **record}))
+        result = main.snip_audio(job["input"], job["start"], job["end"], job["output"],
+                                 cache=render_cache, profiler=profiler, **job["params"])
+        # Stats come from here so the owner never has to wait on the cache lock
+        send({"job": job_id, "type": "done", "result": summarize(result),
+              "cache_stats": None if render_cache is None else render_cache.stats(),
+              "wall_sec": time.perf_counter() - started})
+    except Exception as e:
+        send({"job": job_id, "type": "error", "error": f"{type(e).__name__}: {e}",
+              "wall_sec": time.perf_counter() - started})
+    finally:
+        conn.close()
+
+
+# --- Queue ---
+class JobQueue:
+    """
+    submit() queues a render and returns its id; poll() starts queued jobs as
+    slots free up and returns the events since the last call; cancel() drops a
+    queued job or kills a running one (its partial output is deleted).
+    `jobs` maps id -> job dict with "status", "stage" and "result"/"error".
+
+    cache_dir: each worker opens its own cache.RenderCache there; the cache
+    locks its index, so concurrent jobs can share it.
+    """
+
+    def __init__(self, workers=None, cache_dir=None):
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.cache_dir = cache_dir
+        self.jobs = {}
+        self._ctx = multiprocessing.get_context()
+        self._pending = []
+        self._procs = {}
+        self._conns = {}
+        self._ids = itertools.count(1)
+
+    def submit(self, input_file, start_sec, end_sec, output_file, **params):
+        job_id = next(self._ids)
+        self.jobs[job_id] = {
+            "id": job_id,
+            "input": input_file,
+            "output": output_file,
+            "start": start_sec,
+            "end": end_sec,
+            "params": params,
+            "status": QUEUED,
+            "stage": None,
+            "submitted": time.time(),
+        }
+        self._pending.append(job_id)
+        return job_id
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job["status"] not in (QUEUED, RUNNING):
+            return False
+        if job_id in self._pending:
+            self._pending.remove(job_id)
+        proc = self._procs.pop(job_id, None)
+        if proc is not None:
+            # Only this job's own pipe can be left mid-message
+            proc.terminate()
+            proc.join()
+            self._close_conn(job_id)
+            if os.path.exists(job["output"]):
+                os.remove(job["output"])
+        job["status"] = CANCELLED
+        job["finished"] = time.time()
+        return True
+
+    @property
+    def active(self):
+        return len(self._pending) + len(self._procs)
+
+    def _start_pending(self):
+        while self._pending and len(self._procs) < self.workers:
+            job_id = self._pending.pop(0)
+            job = self.jobs[job_id]
+            reader, writer = self._ctx.Pipe(duplex=False)
+            proc = self._ctx.Process(target=_run_job, args=(job_id, job, writer, self.cache_dir), daemon=True)
+            proc.start()
+            # Our copy of the write end must go, or the reader never sees EOF
+            writer.close()
+            self._procs[job_id] = proc
+            self._conns[job_id] = reader
+            job["status"] = RUNNING
+            job["started"] = time.time()
+
+    def _apply(self, event):
+        job = self.jobs.get(event["job"])
+        if job is None or job["status"] == CANCELLED:
+            # Late events from a job that was killed
+            return False
+        if event["type"] == "stage":
+            job["stage"] = event["stage"]
+        elif event["type"] in ("done", "error"):
+            job["status"] = DONE if event["type"] == "done" else ERROR
+            job["stage"] = None
+            job["finished"] = time.time()
+            job["result" if event["type"] == "done" else "error"] = event.get("result", event.get("error"))
+            proc = self._procs.pop(event["job"], None)
+            if proc is not None:
+                proc.join()
+        return True
+
+    def _close_conn(self, job_id):
+        conn = self._conns.pop(job_id, None)
+        if conn is not None:
+            conn.close()
+
+    def _receive(self, max_events):
+        events = []
+        while len(events) < max_events and self._conns:
+            ready = multiprocessing.connection.wait(list(self._conns.values()), timeout=0)
+            if not ready:
+                break
+            for job_id, conn in list(self._conns.items()):
+                if conn not in ready or len(events) >= max_events:
+                    continue
+                try:
+                    event = conn.recv()
+                except (EOFError, OSError):
+                    # The worker has exited and everything it sent has been read
+                    self._close_conn(job_id)
+                    continue
+                if self._apply(event):
+                    events.append(event)
+        return events
+
+    def poll(self, max_events=POLL_MAX_EVENTS):
+        """Non-blocking: returns up to max_events new events, oldest first per job."""
+        # Bounded, so a chatty render can't starve the caller's event loop
+        events = self._receive(max_events)
+
+        for job_id, proc in list(self._procs.items()):
+            if not proc.is_alive() and proc.exitcode != 0 and job_id not in self._conns:
+                # Died without reporting back (segfault, OOM kill)
+                del self._procs[job_id]
+                event = {"job": job_id, "type": "error", "error": f"worker exited with code {proc.exitcode}"}
+                self._apply(event)
+                events.append(event)
+
+        self._start_pending()
+        return events
+
+    def shutdown(self):
+        for job_id in list(self._pending) + list(self._procs):
+            self.cancel(job_id)
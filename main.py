@@ -2,10 +2,13 @@ import hashlib
 import os
 import datetime
 import numpy as np
-import pyloudnorm as lnr
-from pydub import AudioSegment, effects
-import visualizer
-from scipy.signal import butter, lfilter
+from pydub import AudioSegment
+import engine
+import profiler as prof
+import wavio
+
+# visualizer (matplotlib, librosa), pyloudnorm and scipy.signal are imported by
+# the functions that use them, so importing main stays cheap for headless jobs.
 
 def calculate_phase_correlation(audio_segment):
     samples = np.array(audio_segment.get_array_of_samples()).astype(np.float32)
@@ -30,6 +33,7 @@ def apply_til_eq(audio_segment, tilt_amount=0):
 
     if tilt_amount == 0.0:
         return audio_segment
+    from scipy.signal import lfilter
 
     # Convert to numpy
     samples = np.array(audio_segment.get_array_of_samples()).astype(np.float32)
@@ -65,48 +69,31 @@ def apply_ms_tonal_balance(audio_segment, side_gain_db=2.0):
     # If Audio is mono there's no side channel to process
     if audio_segment.channels < 2:
         return audio_segment
-    # 1. Split to Mono (L/R)
-    channels = audio_segment.split_to_mono()
-    left, right = channels[0], channels[1]
-
-    # 2. Encode to Mid/Side
-    mid = left.overlay(right, gain_during_overlay=-3.0) # (L/R)/2
-    side = left.overlay(right.invert_phase(), gain_during_overlay=-3.0) # (L/R)/2
-
-    # 3. Process the Side channel (e.g., make the sides brighter)
-    side = side.high_pass_filter(500).apply_gain(side_gain_db)
 
-    # 4. Decode back to Stereo
-    # L = Mid + Side, R = Mid - Side
-    new_left = mid.overlay(side)
-    new_right = mid.overlay(side.invert_phase())
+    # M/S encode -> 500Hz side high-pass + gain -> decode, as one NumPy pass
+    buffer = engine.segment_to_buffer(audio_segment)
+    engine.apply_ms_tonal_balance(buffer, audio_segment.frame_rate, side_gain_db=side_gain_db)
+    return engine.buffer_to_segment(buffer, audio_segment.frame_rate, audio_segment.sample_width)
 
-    return AudioSegment.from_mono_audiosegments(new_left, new_right)
+def apply_dither(audio_segment, shape="auto"):
+    # Re-quantizes with TPDF dither at the segment's own bit depth, in one vectorized pass
+    buffer = engine.segment_to_buffer(audio_segment)
+    dither = engine.make_dither(shape, audio_segment.sample_width)
+    return engine.buffer_to_segment(buffer, audio_segment.frame_rate, audio_segment.sample_width, dither=dither)
 
-def apply_dither(audio_segment):
-    # Adds very low-level white noise (-110dBish) to preserve low-level detail
-    white_noise = effects.strip_silence(audio_segment).apply_gain(-110)
-    return audio_segment.overlay(white_noise)
-
-def apply_soft_clip(audio_segment, drive_db=3.0):
-    audio_segment = audio_segment.apply_gain(drive_db)
-
-    samples = np.array(audio_segment.get_array_of_samples()).astype(np.float32)
-    denom =  2**15 if audio_segment.sample_width == 2 else 2**31
-    samples = samples / denom
-
-    clipped = np.tanh(samples)
-
-    final_samples = (clipped * denom).astype(np.int16 if audio_segment.sample_width == 2 else np.int32)
-    return audio_segment._spawn(final_samples.tobytes()).apply_gain(-drive_db)
+def apply_soft_clip(audio_segment, drive_db=3.0, oversample=4):
+    # Oversampled tanh on the float buffer, no pydub gain copies either side
+    buffer = engine.segment_to_buffer(audio_segment)
+    engine.apply_soft_clip(buffer, drive_db=drive_db, oversample=oversample)
+    return engine.buffer_to_segment(buffer, audio_segment.frame_rate, audio_segment.sample_width)
 
 
 # --- File Integrity
 def generate_file_hash(filepath):
     sha256_hash = hashlib.sha256()
     with open(filepath, "rb") as f:
-        # Read in 4k blocks so we don't crash the RAM on the laptop
-        for byte_block in iter(lambda: f.read(4096), b"" ):
+        # 1 MiB blocks: few enough calls to keep up with the disk, small enough for any laptop
+        for byte_block in iter(lambda: f.read(1 << 20), b"" ):
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
 
@@ -117,6 +104,7 @@ def measure_loudness(audio_segment):
         samples = samples.reshape((-1, 2))
     samples =  samples / (2**15) if audio_segment.sample_width == 2 else samples / (2**31)
 
+    import pyloudnorm as lnr
     meter = lnr.Meter(audio_segment.frame_rate)
     loudness =  meter.integrated_loudness(samples)
     return loudness
@@ -160,11 +148,10 @@ def apply_safe_stereo_width(audio, crossover_freq=200, delay_ms=25, dry_wet=0.25
     return low_end.overlay(widened_highs)
 
 def apply_limiter(audio_segment, ceiling=-1.0):
-    current_peak =  audio_segment.max_dBFS
-    if current_peak > ceiling:
-        reduction = ceiling - current_peak
-        return audio_segment.apply_gain(reduction)
-    return audio_segment
+    # Look-ahead true-peak limiter instead of turning the whole track down
+    buffer = engine.segment_to_buffer(audio_segment)
+    engine.apply_limiter(buffer, audio_segment.frame_rate, ceiling=ceiling)
+    return engine.buffer_to_segment(buffer, audio_segment.frame_rate, audio_segment.sample_width)
 
 def match_target_lufs(audio, target_lufs=-14.0, ceiling=-1.0):
     current_lufs = measure_loudness(audio)
@@ -174,20 +161,19 @@ def match_target_lufs(audio, target_lufs=-14.0, ceiling=-1.0):
     return apply_limiter(audio, ceiling=ceiling)
 
 def find_zero_crossing(audio_segment, target_ms):
-    samples = np.array(audio_segment.get_array_of_samples())
-    target_idx = int((target_ms / 1000.0) * audio_segment.frame_rate)
-
-    search_range = int(0.020 * audio_segment.frame_rate)
-    start_search = max(0, target_idx - search_range)
-    end_search = min(len(samples) - 1, target_idx + search_range)
-
-    sub_section = samples[start_search:end_search]
-    zero_cross_idx = np.where(np.diff(np.sign(sub_section)))[0]
+    # Only the +-20 ms search window is converted, and whole frames are searched
+    # (all channels together) instead of interleaved samples
+    sr = audio_segment.frame_rate
+    target = int((target_ms / 1000.0) * sr)
+    search_range = int(engine.ZERO_CROSSING_SEARCH_SEC * sr)
+    start_search = max(0, target - search_range)
+    end_search = min(int(audio_segment.frame_count()), target + search_range)
+    if end_search - start_search < 2:
+        return target_ms
 
-    if len(zero_cross_idx) > 0:
-        best_match = zero_cross_idx[np.abs(zero_cross_idx - (target_idx - start_search)).argmin()]
-        return  (start_search + best_match) / audio_segment.frame_rate * 1000
-    return target_ms
+    window = engine.segment_to_buffer(audio_segment.get_sample_slice(start_search, end_search))
+    best_match = engine.zero_crossing_frame(window, target - start_search)
+    return (start_search + best_match) / sr * 1000
 
 def apply_safe_width(audio_segment, width_factor=1.0):
     """
@@ -195,120 +181,243 @@ def apply_safe_width(audio_segment, width_factor=1.0):
     Mathematically safe for mono compatibility.
     """
 
-    if audio_segment.channels < 2:
+    if audio_segment.channels < 2 or width_factor == 1.0:
         return audio_segment
 
-    # 1. Split to mono
-    channels = audio_segment.split_to_mono()
-    left, right = channels[0], channels[1]
-
-    # 2. Encode to Mid/Side
-    mid = left.overlay(right, gain_during_overlay=-3.0)
-    side = left.overlay(right.invert_phase(), gain_during_overlay=-3.0)
-
-    # 3. Apply width factor (Scale the side channel)
-    # Convert factor to dB: 1.2x width is about +1.6 dB on sides
-    if width_factor != 1.0:
-        side = side.apply_gain(20 * np.log10(width_factor))
-
-    # 4. Decode back to stereo
-    new_left = mid.overlay(side)
-    new_right = mid.overlay(side.invert_phase())
-
-    return AudioSegment.from_mono_audiosegments(new_left, new_right)
-
-def snip_audio(input_file, start_sec, end_sec, output_file, use_clipper=False, hp_cutoff=40, stereo_width=1.0, lp_cutoff=15000, fade_ms=50, export_format="wav"):
-    start_ms = start_sec * 1000
-    end_ms = end_sec * 1000
-
-    print(f"Loading {input_file}...")
-    audio = AudioSegment.from_file(input_file)
+    # Scale the side channel of the M/S matrix, in one NumPy pass
+    buffer = engine.segment_to_buffer(audio_segment)
+    engine.apply_safe_width(buffer, width_factor=width_factor)
+    return engine.buffer_to_segment(buffer, audio_segment.frame_rate, audio_segment.sample_width)
 
-    # --- SMART SNIP LOGIC START ---
-    print(f"Aligning to zero-crossings...")
-    smart_start = find_zero_crossing(audio, start_ms)
-    smart_end = find_zero_crossing(audio, end_ms)
-    processed = audio[smart_start:smart_end]
-
-    # --- EQ Filters ---
-    print(f"Applying Filters ...")
-    processed = processed.high_pass_filter(hp_cutoff).low_pass_filter(lp_cutoff)
-
-    # --- Tilt EQ ---
-    processed = apply_til_eq(processed, tilt_amount=1.0)
-
-    # --- Mid/Side Processing
-    print(f"Applying Mid-Side Processing ...")
-    processed = apply_ms_tonal_balance(processed, side_gain_db=0.7)
-
-    # --- Stereo Widening ---
-    # print(f"Applying Stereo Widening---")
-    # processed = apply_safe_stereo_width(processed, crossover_freq=200, delay_ms=25, dry_wet=0.25)
-    # --NEW--
-    print(f"Applying phase-safe Stereo Widening ({stereo_width}x)...")
-    processed = apply_safe_width(processed, width_factor=stereo_width)
-
-    # --- Normalization & Limiter---
-    print(f"Targeting -14 LUFs & Limiting...")
-    processed = match_target_lufs(processed, target_lufs=-14.0, ceiling=-1.0)
-
-    if use_clipper:
-        print("Applying Soft Clipping (Warmth)...")
-        processed = apply_soft_clip(processed)
-        final_master = apply_limiter(processed, ceiling=-1.0)
+def snip_audio(input_file, start_sec, end_sec, output_file, use_clipper=False, hp_cutoff=40, stereo_width=1.0, lp_cutoff=15000, fade_ms=50, export_format="wav", streaming=False, cache=None, visualize="fast", profiler=None, dither="auto", clip_oversample=4, multiband=None, eq_bands=None, eq_phase="linear", reference=None, reference_strength=1.0, deliverables=None):
+    """
+    visualize: "fast" draws the analysis PNG from the in-memory buffers,
+    "background" does the same on a worker thread (result["analysis_future"]),
+    "full" re-reads both files through librosa, None/False skips it.
+    profiler: a profiler.RenderProfiler to record into; one is made if omitted.
+    Per-stage timings end up in result["timing"].
+    dither: "auto" (shaped at 16-bit, flat TPDF at 24-bit, none at 32-bit),
+    "flat", "highpass", "shaped" or None. Applied while quantizing at export.
+    clip_oversample: 1, 2, 4 or 8; the rate the soft clipper saturates at.
+    multiband: True for the default 3-band compressor, or a dict of
+    dynamics.MultibandCompressor settings (e.g. {"crossovers": (120, 1000, 6000)}).
+    eq_bands: list of parametric EQ band dicts (see eq.py), applied after the
+    tilt EQ as one FIR; eq_phase: "linear" or "minimum".
+    reference: path of a reference track. Its spectrum is matched with an EQ
+    (scaled by reference_strength, 0..1) and its loudness replaces -14 LUFS.
+    Reference profiles are kept in reference.default_library().
+    deliverables: extra outputs written from the same master at the same time,
+    e.g. ["flac", {"format": "mp3", "bitrate": "320k"}] (see export.py). Their
+    SHA-256s go to result["deliverables"] and a sidecar manifest.
+    streaming: render block by block with bounded memory (see streaming.py);
+    `cache` and the visualizer are not used then.
+    """
+    if profiler is None:
+        profiler = prof.RenderProfiler()
+    profiler.start()
+
+    if streaming:
+        # Bounded-memory block render for files that don't fit in RAM (no visualizer, no cache)
+        import streaming as streaming_mode
+        if cache is not None:
+            # Callers like the daemon hand every job their cache, so say so rather than fail
+            print(f"Render cache not used: streaming renders of {input_file} are never cached")
+        result = streaming_mode.stream_master(input_file, output_file, start_sec, end_sec,
+                                            use_clipper=use_clipper, hp_cutoff=hp_cutoff,
+                                            stereo_width=stereo_width, lp_cutoff=lp_cutoff,
+                                            fade_ms=fade_ms, export_format=export_format,
+                                            profiler=profiler, dither=dither,
+                                            clip_oversample=clip_oversample, multiband=multiband,
+                                            eq_bands=eq_bands, eq_phase=eq_phase, reference=reference,
+                                            reference_strength=reference_strength, deliverables=deliverables)
+        return _finish_timing(result, profiler, output_file)
+
+    target_lufs = -14.0
+    ref_profile = None
+    if reference:
+        import reference as reference_lib
+        with profiler.stage("reference_profile"):
+            ref_profile = reference_lib.default_library().profile(reference)
+        print(f"Reference: {reference_lib.describe(ref_profile)}")
+        if np.isfinite(ref_profile["integrated_lufs"]):
+            target_lufs = ref_profile["integrated_lufs"]
+
+    # --- Render Cache ---
+    # A full hit skips the render; a stage hit skips decode + filters
+    if cache is not None:
+        with profiler.stage("cache_lookup"):
+            input_sha = cache.input_hash(input_file)
+            stage_params = {"start_sec": start_sec, "end_sec": end_sec, "hp_cutoff": hp_cutoff, "lp_cutoff": lp_cutoff,
+                            "eq_bands": eq_bands, "eq_phase": eq_phase,
+                            "reference": ref_profile["sha256"] if ref_profile else None,
+                            "reference_strength": reference_strength}
+            render_params = dict(stage_params, use_clipper=use_clipper, stereo_width=stereo_width,
+                                 fade_ms=fade_ms, export_format=export_format, dither=dither,
+                                 clip_oversample=clip_oversample, multiband=multiband)
+            render_key = cache.key(input_sha, "render", render_params)
+            stage_key = cache.key(input_sha, "stage", stage_params)
+            # The render cache only keeps the primary output, so fan-outs always re-export
+            cached = None if deliverables else cache.get_render(render_key, output_file, need_analysis=bool(visualize))
+            cached_stage = cache.get_stage(stage_key) if cached is None else None
+        if cached is not None:
+            print(f"Cache hit: {output_file} (SHA-256 {cached['sha256']})")
+            return _finish_timing(cached, profiler, output_file)
     else:
-        print("Applying Clean Normalization...")
-        final_master = effects.normalize(processed, headroom=0.1)
-
-    # --- Lufs ---
-    lufs = measure_loudness(final_master)
-    print(f"Loudness: {lufs:.2f} LUFS")
-
-    if lufs < -16:
-        print("Note: This track might be a bit quiet for streaming (-14 LUFs is the target).")
-    elif lufs > -9:
-        print("Note: This track is very loud/compressed (Club/EDM levels).")
-
-    # --- Fades ---
-    print(f"Applying {fade_ms}ms Fades...")
-    final_master = final_master.fade_in(fade_ms).fade_out(fade_ms)
-
-    # --- FINAL ANALYSIS BLOCK --
-    lufs = measure_loudness(final_master)
-    print(f"Loudness: {lufs:.2f} LUFs")
-    check_mono_compatibility(final_master)
+        cached_stage = None
+
+    fast_preview = visualize in ("fast", "background")
+    if visualize:
+        import visualizer
+    original_preview = None
+    if cached_stage is not None:
+        print(f"Cache hit: reusing decoded & filtered audio for {input_file}")
+        buffer, stage_meta, original_preview = cached_stage
+        sample_rate = stage_meta["sample_rate"]
+        sample_width = stage_meta["sample_width"]
+    else:
+        import streaming as streaming_mode
+
+        # Only the snip (plus the zero-crossing margins) is ever decoded
+        print(f"Loading {input_file} ({start_sec}s to {end_sec}s)...")
+        with profiler.stage("decode"):
+            source = None
+            if wavio.is_wav(input_file):
+                try:
+                    # PCM WAV is memory-mapped; nothing is read until it's used
+                    source = wavio.WavFile(input_file)
+                except wavio.WavFormatError:
+                    pass
+            if source is None:
+                source = streaming_mode.decode_region(input_file, start_sec, end_sec)
+
+        # --- SMART SNIP LOGIC START ---
+        print(f"Aligning to zero-crossings...")
+        with profiler.stage("zero_crossing"):
+            smart_start = engine.snap_to_zero_crossing(source, int(start_sec * source.sample_rate))
+            smart_end = engine.snap_to_zero_crossing(source, int(end_sec * source.sample_rate))
+
+        # Decode once into a float32 buffer; every stage runs in place on it
+        sample_rate = source.sample_rate
+        sample_width = source.export_width
+        with profiler.stage("to_float"):
+            buffer = source.read(smart_start, smart_end)
+        source.close()
+        if not len(buffer):
+            raise ValueError(f"{input_file}: no audio between {start_sec}s and {end_sec}s")
+
+        # The chain works in place, so grab the small preview of the original now
+        if fast_preview:
+            with profiler.stage("preview_original", buffer):
+                original_preview = visualizer.preview_data(buffer, sample_rate)
+
+        engine.render_filters(buffer, sample_rate, hp_cutoff=hp_cutoff, lp_cutoff=lp_cutoff, profiler=profiler,
+                              eq_bands=eq_bands, eq_phase=eq_phase)
+        if ref_profile is not None:
+            import eq
+            # Measured after the static filters, so the match only adds what they didn't
+            with profiler.stage("reference_match", buffer):
+                target_profile = reference_lib.profile_buffer(buffer, sample_rate)
+                match = reference_lib.matching_bands(ref_profile, target_profile, sample_rate, reference_strength)
+                print(f"Applying Reference Match EQ ({len(match)} bands)...")
+                eq.apply_eq(buffer, sample_rate, match)
+        if cache is not None:
+            with profiler.stage("cache_store_stage", buffer):
+                cache.put_stage(stage_key, buffer, {"sample_rate": sample_rate, "sample_width": sample_width},
+                                preview=original_preview)
+
+    buffer, report = engine.render_finish(buffer, sample_rate,
+                                          use_clipper=use_clipper,
+                                          stereo_width=stereo_width,
+                                          fade_ms=fade_ms,
+                                          profiler=profiler,
+                                          clip_oversample=clip_oversample,
+                                          multiband=multiband,
+                                          target_lufs=target_lufs)
 
     # Metadata and Signatures
     now_full = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     now_short = datetime.datetime.now().strftime("%H:%M:%S")
 
-    # --- Apply Dither ---
-    final_master = apply_dither(final_master)
-
-
-    # Export
-    final_master.export(output_file, format=export_format, tags={
+    tags = {
         "artist": "Mastered by Python Tool",
         "date": now_full
-    })
-
-    # Generate Final Signature
-    sig = generate_file_hash(output_file)
+    }
+    # Dithered and quantized block by block straight into each file (or encoder),
+    # hashing the bytes on the way out, so there is no read-back pass
+    import export
+    specs = export.resolve_deliverables(output_file, export_format, sample_width, deliverables)
+    with profiler.stage("export", buffer):
+        records = export.export_buffer(buffer, sample_rate, specs, tags=tags, dither=dither)
+    sig = records[0]["sha256"]
+    manifest = None
+    if deliverables:
+        manifest = export.write_manifest(output_file, records, report=report,
+                                         source={"input_file": input_file, "start_sec": start_sec, "end_sec": end_sec})
+        for record in records[1:]:
+            print(f"[{now_short}] Deliverable: {record['path']} (SHA-256 {record['sha256']})")
 
     # Visualizer Call
-    visualizer.visualize_mastering(input_file, output_file)
+    image_filename = None
+    analysis_future = None
+    if fast_preview and original_preview is None:
+        # Stage cached before previews were kept; fall back to the slow path
+        visualize = "full"
+    if fast_preview and visualize != "full":
+        image_filename = visualizer.analysis_image_path(output_file)
+        with profiler.stage("visualizer", buffer):
+            mastered_preview = visualizer.preview_data(buffer, sample_rate)
+            if visualize == "background":
+                analysis_future = visualizer.render_preview_async(original_preview, mastered_preview, image_filename)
+            else:
+                visualizer.render_preview(original_preview, mastered_preview, image_filename)
+    elif visualize == "full":
+        with profiler.stage("visualizer"):
+            image_filename = visualizer.visualize_mastering(input_file, output_file)
 
     print(f"[{now_short}] Done: {output_file}")
     print(f"[{now_short}] SHA-256 Signature: {sig}")
 
+    result = {
+        "output_file": output_file,
+        "sha256": sig,
+        "duration_sec": len(buffer) / sample_rate,
+        "lufs": report["integrated_lufs"],
+        "analysis": report,
+        "analysis_image": image_filename,
+    }
+    if deliverables:
+        result["deliverables"] = records
+        result["manifest"] = manifest
+    elif cache is not None:
+        # A background PNG isn't on disk yet, so it joins the entry once it's drawn
+        with profiler.stage("cache_store_render"):
+            cache.put_render(render_key, output_file, result,
+                             image_filename=image_filename if analysis_future is None else None)
+        if analysis_future is not None:
+            def cache_image(future):
+                if future.exception() is None:
+                    cache.put_render_image(render_key, future.result())
+            analysis_future.add_done_callback(cache_image)
+    if analysis_future is not None:
+        result["analysis_future"] = analysis_future
+    return _finish_timing(result, profiler, output_file)
+
+
+def _finish_timing(result, profiler, output_file):
+    """Closes the profiling session and attaches the timing report to the result."""
+    base = os.path.splitext(output_file)[0]
+    profiler.stop(profile_path=base + ".prof" if profiler.cprofile else None)
+    result = dict(result, timing=profiler.report())
+    if profiler.deep:
+        # Deep runs leave the report next to the master for later inspection
+        result["timing_file"] = profiler.save(base + "_timing.json")
+        print(f"Profile saved: {result['timing_file']}")
+    print(f"Render time: {result['timing']['total_wall_sec']:.2f}s")
+    return result
+
 # --- Batch Processor ---
-def batch_process(input_folder, output_folder, start, end, use_clipper=False):
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-
-    for filename in os.listdir(input_folder):
-        if filename.endswith((".wav", ".mp3", ".flac")):
-            input_path = os.path.join(input_folder, filename)
-            output_path = os.path.join(output_folder, f"mastered_{filename}")
-            ext = filename.split('.')[-1]
-            snip_audio(input_path, start, end, output_path, use_clipper=use_clipper, export_format=ext)
+def batch_process(input_folder, output_folder, start, end, use_clipper=False, workers=None, timeout=None):
+    # Parallel, resumable runner; see batch.py for the manifest format
+    import batch
+    return batch.run_batch(input_folder, output_folder, start, end,
+                           workers=workers, timeout=timeout, use_clipper=use_clipper)
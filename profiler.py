@@ -0,0 +1,154 @@
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Windows: no getrusage, so peak RSS is reported as None
+    resource = None
+
+# Per-render instrumentation. Every stage of the chain records wall time, CPU
+# time, RSS change and the size of the buffer it worked on; the records make up
+# a JSON-able timing report. The timers cost microseconds per stage, so they are
+# always on. cProfile and tracemalloc are heavier and only run when asked for,
+# either with the arguments below or with MASTERING_PROFILE=cprofile,tracemalloc
+# in the environment, so a slow production render can be re-run with them on.
+
+PROFILE_ENV = "MASTERING_PROFILE"
+PROFILE_TOP_N = 15
+
+
+def _current_rss_bytes():
+    # Linux only; elsewhere we just report the peak figures
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _mb(value):
+    return None if value is None else round(value / 2**20, 3)
+
+
+class RenderProfiler:
+    def __init__(self, callback=None, cprofile=None, trace_memory=None):
+        """
+        callback: called with each stage record as it finishes (e.g. the GUI log).
+        cprofile / trace_memory: None means "read MASTERING_PROFILE".
+        """
+        requested = {flag.strip() for flag in os.environ.get(PROFILE_ENV, "").lower().split(",")}
+        self.callback = callback
+        self.cprofile = "cprofile" in requested if cprofile is None else cprofile
+        self.trace_memory = "tracemalloc" in requested if trace_memory is None else trace_memory
+
+        self.stages = []
+        self._started = None
+        self._profile = None
+        self._started_tracemalloc = False
+        self._total = None
+        self._memory_top = None
+        self.profile_path = None
+
+    # --- Session ---
+    def start(self):
+        self._started = (time.perf_counter(), time.process_time())
+        if self.cprofile:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        return self
+
+    def stop(self, profile_path=None):
+        """Ends the session; with cProfile on, dumps pstats to profile_path if given."""
+        if self._profile is not None:
+            self._profile.disable()
+            if profile_path:
+                self._profile.dump_stats(profile_path)
+                self.profile_path = profile_path
+        if self.trace_memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            self._memory_top = [
+                {"site": str(stat.traceback), "size_mb": _mb(stat.size), "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]
+            ]
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+        if self._started is not None:
+            self._total = (time.perf_counter() - self._started[0], time.process_time() - self._started[1])
+
+    # --- Stages ---
+    @contextlib.contextmanager
+    def stage(self, name, buffer=None):
+        rss_before = _current_rss_bytes()
+        peak_before = _peak_rss_bytes()
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = {
+                "stage": name,
+                "wall_sec": round(time.perf_counter() - wall, 6),
+                "cpu_sec": round(time.process_time() - cpu, 6),
+                "peak_rss_growth_mb": _mb(None if peak_before is None else _peak_rss_bytes() - peak_before),
+                "rss_delta_mb": _mb(None if rss_before is None else _current_rss_bytes() - rss_before),
+                "buffer_mb": _mb(getattr(buffer, "nbytes", None)),
+            }
+            if self.trace_memory and tracemalloc.is_tracing():
+                record["traced_peak_mb"] = _mb(tracemalloc.get_traced_memory()[1])
+            self.stages.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    # --- Report ---
+    def report(self):
+        total_wall, total_cpu = self._total or (sum(s["wall_sec"] for s in self.stages), None)
+        report = {
+            "total_wall_sec": round(total_wall, 6),
+            "total_cpu_sec": None if total_cpu is None else round(total_cpu, 6),
+            "peak_rss_mb": _mb(_peak_rss_bytes()),
+            "stages": self.stages,
+        }
+        if self._profile is not None:
+            out = io.StringIO()
+            pstats.Stats(self._profile, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+            report["cprofile_top"] = out.getvalue()
+            report["cprofile_path"] = self.profile_path
+        if self._memory_top:
+            report["tracemalloc_top"] = self._memory_top
+        return report
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+    @property
+    def deep(self):
+        return self.cprofile or self.trace_memory
+
+
+def stage(profiler, name, buffer=None):
+    """profiler.stage(...) when there is a profiler, a no-op otherwise."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name, buffer)
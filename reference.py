@@ -0,0 +1,258 @@
+import json
+import os
+import time
+import numpy as np
+from scipy import fft
+
+import analysis
+import cache
+import eq
+
+# Reference matching. A reference track is reduced to a profile: its long-term
+# average spectrum (Welch, accumulated block by block so any length works on
+# bounded memory) plus integrated loudness, peak, RMS and crest factor. The
+# target gets the same profile after the static filters, and the smoothed
+# difference is fitted with a row of bell bands that eq.py turns into one FIR.
+# Profiles are stored in an on-disk library keyed by the reference's SHA-256,
+# so a batch matched against one reference analyses it once.
+
+REF_SEGMENT = 8192
+REF_BLOCK_FRAMES = 262144
+DEFAULT_LIBRARY_DIR = os.path.join(os.path.expanduser("~"), ".cache", "python_mastering_tool", "references")
+INDEX_NAME = "index.json"
+LOCK_NAME = "index.lock"
+
+# Matching EQ: fitted on a 1/12-octave grid from the 1/3-octave smoothed spectra,
+# with one-octave-wide bells every half octave from 40 Hz
+MATCH_SMOOTHING_OCT = 1.0 / 3.0
+MATCH_GRID_OCT = 1.0 / 12.0
+MATCH_LOW_HZ = 30.0
+MATCH_HIGH_HZ = 16000.0
+MATCH_FIRST_BAND_HZ = 40.0
+MATCH_BAND_SPACING_OCT = 0.5
+MATCH_BAND_Q = 1.41
+MATCH_MAX_DB = 6.0
+
+
+# --- Profiles ---
+class SpectrumAccumulator:
+    """
+    Welch average of the mid signal (Hann, 50% overlap), fed block by block.
+    The tail that doesn't fill a segment is carried into the next block, so
+    the segments are the same however the audio is split. Mid is used because
+    the M/S stage leaves it untouched.
+    """
+
+    def __init__(self, sample_rate, segment=REF_SEGMENT):
+        self.sample_rate = sample_rate
+        self.segment = segment
+        self.hop = segment // 2
+        self.window = np.hanning(segment + 2)[1:-1]
+        self._carry = np.zeros(0)
+        self._power = np.zeros(segment // 2 + 1)
+        self.segments = 0
+
+    def add(self, block):
+        data = np.concatenate([self._carry, block.mean(axis=1, dtype=np.float64)])
+        count = (len(data) - self.segment) // self.hop + 1 if len(data) >= self.segment else 0
+        if count:
+            frames = np.lib.stride_tricks.sliding_window_view(data, self.segment)[::self.hop][:count]
+            spectra = fft.rfft(frames * self.window, axis=1)
+            self._power += np.sum(spectra.real ** 2 + spectra.imag ** 2, axis=0)
+            self.segments += count
+        self._carry = data[count * self.hop:]
+
+    def psd(self):
+        """(freqs, one-sided power spectral density)."""
+        freqs = np.fft.rfftfreq(self.segment, 1.0 / self.sample_rate)
+        psd = self._power / max(self.segments, 1) / (self.sample_rate * np.sum(self.window ** 2))
+        psd[1:-1] *= 2
+        return freqs, psd
+
+
+def profile_blocks(blocks, sample_rate, channels):
+    """Profile of a stream of float32 (frames, channels) blocks."""
+    spectrum = SpectrumAccumulator(sample_rate)
+    meter = analysis.LoudnessMeter(sample_rate, channels)
+    peak = 0.0
+    energy = 0.0
+    frames = 0
+    for block in blocks:
+        spectrum.add(block)
+        meter.add(block)
+        if len(block):
+            peak = max(peak, float(np.max(np.abs(block))))
+        energy += float(np.sum(np.square(block, dtype=np.float64)))
+        frames += len(block)
+
+    freqs, psd = spectrum.psd()
+    with np.errstate(divide="ignore"):
+        peak_db = 20 * np.log10(peak)
+        rms_db = 10 * np.log10(energy / max(frames * channels, 1))
+    return {
+        "sample_rate": sample_rate,
+        "freqs": freqs,
+        "psd": psd,
+        "integrated_lufs": float(meter.integrated_loudness()),
+        "peak_db": float(peak_db),
+        "rms_db": float(rms_db),
+        "crest_db": float(peak_db - rms_db),
+        "duration_sec": frames / sample_rate,
+    }
+
+
+def profile_buffer(buffer, sample_rate):
+    blocks = (buffer[pos:pos + REF_BLOCK_FRAMES] for pos in range(0, len(buffer), REF_BLOCK_FRAMES))
+    return profile_blocks(blocks, sample_rate, buffer.shape[1])
+
+
+def _file_blocks(reader):
+    reader.seek(0)
+    while True:
+        block = reader.read(REF_BLOCK_FRAMES)
+        if not len(block):
+            return
+        yield block
+
+
+def profile_file(path):
+    """Profile of a whole file, read block by block (any format streaming.py can read)."""
+    import streaming
+
+    reader = streaming.open_block_reader(path)
+    try:
+        return profile_blocks(_file_blocks(reader), reader.sample_rate, reader.channels)
+    finally:
+        reader.close()
+
+
+# --- Library ---
+class ReferenceLibrary:
+    """
+    On-disk store of reference profiles, keyed by the reference file's SHA-256.
+    The spectrum goes in an .npz per reference, the scalars in the index.
+    Safe to share between processes: each reference has its own lock file, so
+    when a batch's workers all ask for the same reference one analyses it and
+    the others wait and load the result.
+    """
+
+    def __init__(self, library_dir=DEFAULT_LIBRARY_DIR):
+        self.library_dir = library_dir
+        os.makedirs(library_dir, exist_ok=True)
+        self._index_path = os.path.join(library_dir, INDEX_NAME)
+        self._lock_path = os.path.join(library_dir, LOCK_NAME)
+        self.file_hash = cache.FileHashes()
+        self._profiles = {}
+        self._load_index()
+
+    def _load_index(self):
+        self.entries = {}
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f).get("entries", {})
+            except (OSError, json.JSONDecodeError):
+                self.entries = {}
+
+    def _update_index(self, change):
+        # Re-read under the lock so other processes' entries survive
+        with cache.file_lock(self._lock_path):
+            self._load_index()
+            change(self.entries)
+            cache.write_atomically(self._index_path, lambda f: json.dump({"entries": self.entries}, f))
+
+    def _path(self, sha, extension):
+        return os.path.join(self.library_dir, sha + extension)
+
+    def profile(self, path):
+        """The profile of a reference file, analysed only if the library doesn't have it yet."""
+        sha = self.file_hash(path)
+        if sha in self._profiles:
+            return self._profiles[sha]
+
+        spectrum_path = self._path(sha, ".npz")
+        with cache.file_lock(self._path(sha, ".lock")):
+            # Another process may have added it since we loaded the index
+            self._load_index()
+            entry = self.entries.get(sha)
+            if entry is not None and os.path.exists(spectrum_path):
+                with np.load(spectrum_path) as data:
+                    profile = dict(entry["meta"], freqs=data["freqs"], psd=data["psd"])
+            else:
+                print(f"Analysing reference {path}...")
+                profile = profile_file(path)
+                cache.write_atomically(spectrum_path, lambda f: np.savez(f, freqs=profile["freqs"], psd=profile["psd"]),
+                                       binary=True)
+                meta = {k: v for k, v in profile.items() if k not in ("freqs", "psd")}
+                self._update_index(lambda entries: entries.update(
+                    {sha: {"meta": meta, "source": os.path.abspath(path), "created": time.time()}}))
+
+        profile["sha256"] = sha
+        self._profiles[sha] = profile
+        return profile
+
+    def remove(self, sha):
+        self._profiles.pop(sha, None)
+        with cache.file_lock(self._path(sha, ".lock")):
+            self._update_index(lambda entries: entries.pop(sha, None))
+            if os.path.exists(self._path(sha, ".npz")):
+                os.remove(self._path(sha, ".npz"))
+
+
+_default_library = None
+
+
+def default_library():
+    global _default_library
+    if _default_library is None:
+        _default_library = ReferenceLibrary()
+    return _default_library
+
+
+# --- Matching EQ ---
+def smoothed_db(profile, freqs, fraction=MATCH_SMOOTHING_OCT):
+    """Fractional-octave average of a profile's spectrum at `freqs`, in dB."""
+    bins, psd = profile["freqs"], profile["psd"]
+    cumulative = np.concatenate([[0.0], np.cumsum(psd)])
+    lo = np.searchsorted(bins, freqs * 2 ** (-fraction / 2))
+    hi = np.searchsorted(bins, freqs * 2 ** (fraction / 2))
+    # Narrow low-frequency bands still get at least one bin
+    hi = np.minimum(np.maximum(hi, lo + 1), len(psd))
+    lo = np.minimum(lo, hi - 1)
+    power = (cumulative[hi] - cumulative[lo]) / (hi - lo)
+    return 10 * np.log10(np.maximum(power, 1e-20))
+
+
+def _bells(centres, gains):
+    return [{"type": "bell", "freq": round(float(f), 1), "gain_db": round(float(g), 2), "q": MATCH_BAND_Q}
+            for f, g in zip(centres, gains)]
+
+
+def matching_bands(reference_profile, target_profile, sample_rate, strength=1.0, max_db=MATCH_MAX_DB):
+    """
+    Bell bands (eq.py dicts) that move the target's tonal balance toward the
+    reference. Overall level is left alone (loudness is matched separately),
+    the correction is limited to +/- max_db and scaled by strength.
+    """
+    nyquist = 0.5 * min(sample_rate, reference_profile["sample_rate"], target_profile["sample_rate"])
+    high = min(MATCH_HIGH_HZ, 0.9 * nyquist)
+    grid = MATCH_LOW_HZ * 2 ** np.arange(0, np.log2(high / MATCH_LOW_HZ), MATCH_GRID_OCT)
+    difference = smoothed_db(reference_profile, grid) - smoothed_db(target_profile, grid)
+    difference -= difference.mean()
+    target_curve = strength * np.clip(difference, -max_db, max_db)
+
+    centres = MATCH_FIRST_BAND_HZ * 2 ** np.arange(0, np.log2(high / MATCH_FIRST_BAND_HZ), MATCH_BAND_SPACING_OCT)
+    # Bells barely interact in dB at these gains, so fit them as a linear basis
+    # (1 dB each) with a little ridge to keep neighbours from fighting, then
+    # correct once against the real combined response
+    basis = np.column_stack([20 * np.log10(eq.response(_bells([f], [1.0]), sample_rate, grid)) for f in centres])
+    solve = np.linalg.solve(basis.T @ basis + 0.05 * np.eye(len(centres)), basis.T)
+    gains = np.clip(solve @ target_curve, -max_db, max_db)
+    actual = 20 * np.log10(eq.response(_bells(centres, gains), sample_rate, grid))
+    gains = np.clip(gains + solve @ (target_curve - actual), -max_db, max_db)
+    return [band for band in _bells(centres, gains) if abs(band["gain_db"]) >= 0.1]
+
+
+def describe(profile):
+    return (f"{profile['integrated_lufs']:.1f} LUFS, peak {profile['peak_db']:.1f} dBFS, "
+            f"crest {profile['crest_db']:.1f} dB")
@@ -0,0 +1,360 @@
+import subprocess
+import datetime
+import numpy as np
+from pydub.utils import mediainfo
+
+import analysis
+import dynamics
+import engine
+import profiler as prof
+import wavio
+
+# Streaming render mode: the input is read in fixed-size blocks, the IIR stages
+# carry their filter state from block to block, and the output is written as we
+# go. Loudness uses two passes (analyse, then apply), so peak memory depends on
+# block_frames and not on how long the track is.
+
+DEFAULT_BLOCK_FRAMES = 262144
+# ffprobe says these decode to float, but pydub treats them as 16-bit sources
+LOSSY_CODECS = ("mp3", "aac", "mp4", "webm", "ogg", "vorbis", "opus")
+
+
+# --- Block Readers ---
+class WavBlockReader:
+    """Reads PCM WAV files block by block from a memory map (see wavio.py)."""
+
+    def __init__(self, path):
+        self._wav = wavio.WavFile(path)
+        self.sample_rate = self._wav.sample_rate
+        self.channels = self._wav.channels
+        self.sample_width = self._wav.export_width
+        self.frames = self._wav.frames
+        self._pos = 0
+
+    def seek(self, frame):
+        self._pos = min(frame, self.frames)
+
+    def read(self, n_frames):
+        block = self._wav.read(self._pos, self._pos + n_frames)
+        self._pos += len(block)
+        return block
+
+    def close(self):
+        self._wav.close()
+
+
+def probe_sample_width(info):
+    """
+    Export sample width for a pydub mediainfo() dict, picked the way pydub's
+    own decoder does. ffprobe gives bits_per_sample=0 for compressed codecs
+    like FLAC, so the real depth comes from bits_per_raw_sample or sample_fmt.
+    """
+    sample_fmt = info.get("sample_fmt", "")
+    if sample_fmt.startswith("flt") and info.get("codec_name") in LOSSY_CODECS:
+        return 2
+    for key in ("bits_per_sample", "bits_per_raw_sample"):
+        # "0" or "N/A" when the codec doesn't say
+        bits = info.get(key) or ""
+        if bits.isdigit() and int(bits):
+            return 2 if int(bits) <= 16 else 4
+    if sample_fmt.startswith(("u8", "s16")):
+        return 2
+    return 4 if sample_fmt.startswith(("s32", "s64", "flt", "dbl")) else 2
+
+
+class FfmpegBlockReader:
+    """Decodes any ffmpeg-readable file to float32 through a pipe, block by block."""
+
+    def __init__(self, path):
+        info = mediainfo(path)
+        self.path = path
+        self.sample_rate = int(info["sample_rate"])
+        self.channels = int(info["channels"])
+        self.sample_width = probe_sample_width(info)
+        # Only an estimate for compressed formats; the analysis pass counts exact frames
+        self.frames = int(float(info.get("duration", 0)) * self.sample_rate)
+        self._proc = None
+        self.seek(0)
+
+    def seek(self, frame):
+        self.close()
+        cmd = ["ffmpeg", "-v", "error", "-ss", f"{frame / self.sample_rate:.6f}", "-i", self.path,
+               "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(self.channels), "-ar", str(self.sample_rate), "-"]
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def read(self, n_frames):
+        raw = self._proc.stdout.read(n_frames * self.channels * 4)
+        return np.frombuffer(raw, dtype=np.float32).reshape((-1, self.channels)).copy()
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdout.close()
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+
+
+def open_block_reader(path):
+    if wavio.is_wav(path):
+        try:
+            return WavBlockReader(path)
+        except wavio.WavFormatError:
+            # Compressed payloads in a WAV container go through ffmpeg
+            pass
+    return FfmpegBlockReader(path)
+
+
+# --- Region Decode ---
+class DecodedRegion:
+    """
+    Frames [offset, offset + len(buffer)) of a file, decoded to float32. Has the
+    same read(start, end) / sample_rate / frames interface as wavio.WavFile, in
+    absolute frame numbers, so snip and zero-crossing code works on either.
+    """
+
+    def __init__(self, buffer, offset, sample_rate, sample_width):
+        self.buffer = buffer
+        self.offset = offset
+        self.sample_rate = sample_rate
+        self.channels = buffer.shape[1]
+        self.export_width = sample_width
+        self.frames = offset + len(buffer)
+
+    def read(self, start=0, end=None):
+        end = self.frames if end is None else min(end, self.frames)
+        start = min(max(start, self.offset), end)
+        return self.buffer[start - self.offset:end - self.offset].copy()
+
+    def close(self):
+        self.buffer = None
+
+
+def decode_region(path, start_sec, end_sec, margin_sec=engine.ZERO_CROSSING_SEARCH_SEC):
+    """
+    Decodes only [start_sec - margin, end_sec + margin] of a file, so cutting a
+    short snip out of a long compressed track costs about as much as the snip.
+    The margin leaves room for the zero-crossing search at both ends.
+    """
+    reader = open_block_reader(path)
+    try:
+        # Same frame arithmetic as engine.snap_to_zero_crossing, so its search
+        # window lies inside the region to the frame
+        margin = int(margin_sec * reader.sample_rate)
+        first = max(0, int(start_sec * reader.sample_rate) - margin)
+        last = int(end_sec * reader.sample_rate) + margin
+        reader.seek(first)
+        buffer = reader.read(last - first)
+        return DecodedRegion(buffer, first, reader.sample_rate, reader.sample_width)
+    finally:
+        reader.close()
+
+
+# --- Block Writers ---
+def open_block_writer(path, sample_rate, channels, sample_width, export_format="wav", tags=None, frames=None,
+                      dither="auto", deliverables=None):
+    """A writer for the primary output plus any deliverables, hashing as it writes (see export.py)."""
+    import export
+    specs = export.resolve_deliverables(path, export_format, sample_width, deliverables)
+    return export.MultiWriter(specs, sample_rate, channels, frames, tags=tags, dither=dither)
+
+
+# --- Streaming Render ---
+def _blocks(reader, start_frame, end_frame, block_frames):
+    reader.seek(start_frame)
+    pos = start_frame
+    while end_frame is None or pos < end_frame:
+        want = block_frames if end_frame is None else min(block_frames, end_frame - pos)
+        block = reader.read(want)
+        if not len(block):
+            break
+        pos += len(block)
+        yield block
+
+
+def _filter_stages(blocks, sample_rate, state, hp_cutoff, lp_cutoff, stereo_width, compressor=None,
+                   equalizer=None):
+    # A generator: the parametric EQ lags its input, so blocks can come out
+    # shorter than they went in and its tail is drained after the last one
+    def _after_eq(block):
+        engine.apply_mid_side(block, sample_rate, side_gain_db=0.7, width_factor=stereo_width, state=state)
+        if compressor is not None:
+            compressor.process(block)
+        return block
+
+    for block in blocks:
+        engine.apply_high_pass(block, sample_rate, hp_cutoff, state=state)
+        engine.apply_low_pass(block, sample_rate, lp_cutoff, state=state)
+        engine.apply_til_eq(block, sample_rate, tilt_amount=1.0, state=state)
+        if equalizer is not None:
+            block = equalizer.process(block)
+            if not len(block):
+                continue
+        yield _after_eq(block)
+    if equalizer is not None:
+        tail = equalizer.flush()
+        if len(tail):
+            yield _after_eq(tail)
+
+
+def _make_compressor(multiband, sample_rate, channels):
+    # A fresh one per pass, so the analysis pass sees exactly what the render pass will
+    if not multiband:
+        return None
+    return dynamics.MultibandCompressor(sample_rate, channels, **(multiband if isinstance(multiband, dict) else {}))
+
+
+def _make_equalizer(eq_bands, eq_phase, sample_rate, channels):
+    # Also fresh per pass; the kernel itself comes from eq's cache
+    if not eq_bands:
+        return None
+    import eq
+    return eq.ParametricEQ(eq_bands, sample_rate, channels, phase=eq_phase)
+
+
+def stream_master(input_file, output_file, start_sec=0, end_sec=None, use_clipper=False, hp_cutoff=40,
+                  stereo_width=1.0, lp_cutoff=15000, fade_ms=50, export_format="wav",
+                  block_frames=DEFAULT_BLOCK_FRAMES, profiler=None, dither="auto", clip_oversample=4,
+                  multiband=None, eq_bands=None, eq_phase="linear", reference=None, reference_strength=1.0,
+                  deliverables=None):
+    """
+    Same chain as snip_audio, but block by block with bounded memory.
+    Pass 1 runs the filters and measures loudness; pass 2 runs them
+    again from the same filter start state, applies the resulting gain, and
+    writes the output incrementally. end_sec=None renders to the end of file.
+    Snip points are frame-accurate (no zero-crossing search, the fades cover it).
+    The stages interleave per block, so profiler only sees each pass as a whole.
+    With a reference, an extra pass first profiles the filtered target; the
+    matching bands join eq_bands and the reference loudness replaces -14 LUFS.
+    deliverables are written block by block alongside the primary output.
+    """
+    reader = open_block_reader(input_file)
+    sample_rate, channels = reader.sample_rate, reader.channels
+    # The source's export width, as snip_audio uses (8-bit stays 8-bit)
+    sample_width = reader.sample_width
+    start_frame = int(start_sec * sample_rate)
+    end_frame = int(end_sec * sample_rate) if end_sec is not None else None
+
+    try:
+        if end_frame is not None and end_frame <= start_frame:
+            raise ValueError(f"{input_file}: no audio between {start_sec}s and {end_sec}s")
+        target_lufs = -14.0
+        if reference:
+            # --- Pass 0: Reference Match ---
+            import reference as reference_lib
+            print(f"Streaming pass 0/2: profiling {input_file} against {reference}...")
+            with prof.stage(profiler, "reference_match"):
+                ref_profile = reference_lib.default_library().profile(reference)
+                blocks = _blocks(reader, start_frame, end_frame, block_frames)
+                equalizer = _make_equalizer(eq_bands, eq_phase, sample_rate, channels)
+                target_profile = reference_lib.profile_blocks(
+                    _filter_stages(blocks, sample_rate, {}, hp_cutoff, lp_cutoff, stereo_width, None, equalizer),
+                    sample_rate, channels)
+                match = reference_lib.matching_bands(ref_profile, target_profile, sample_rate, reference_strength)
+            print(f"Reference: {reference_lib.describe(ref_profile)}; matching EQ with {len(match)} bands")
+            eq_bands = list(eq_bands or []) + match
+            if np.isfinite(ref_profile["integrated_lufs"]):
+                target_lufs = ref_profile["integrated_lufs"]
+
+        # --- Pass 1: Analyse ---
+        print(f"Streaming pass 1/2: analysing {input_file}...")
+        state = {}
+        compressor = _make_compressor(multiband, sample_rate, channels)
+        meter = analysis.LoudnessMeter(sample_rate, channels)
+        total_frames = 0
+        with prof.stage(profiler, "stream_analyse"):
+            blocks = _blocks(reader, start_frame, end_frame, block_frames)
+            equalizer = _make_equalizer(eq_bands, eq_phase, sample_rate, channels)
+            for block in _filter_stages(blocks, sample_rate, state, hp_cutoff, lp_cutoff, stereo_width,
+                                        compressor, equalizer):
+                meter.add(block)
+                total_frames += len(block)
+        if not total_frames:
+            # The region starts past the end of the file
+            raise ValueError(f"{input_file}: no audio between {start_sec}s and {end_sec}s")
+
+        # --- Gain Plan ---
+        # The loudness gain is static, so it comes straight from pass 1. The
+        # true-peak limiters are stateful and run block by block in pass 2.
+        current_lufs = meter.integrated_loudness()
+        gain = engine.db_to_gain(target_lufs - current_lufs) if np.isfinite(current_lufs) else 1.0
+        print(f"Targeting {target_lufs:g} LUFs & Limiting (measured {current_lufs:.2f} LUFS, gain {20 * np.log10(gain):+.2f} dB)...")
+
+        limiter = dynamics.TruePeakLimiter(sample_rate, channels, ceiling=-1.0)
+        clipper = dynamics.SoftClipper(channels, oversample=clip_oversample) if use_clipper else None
+        clip_limiter = dynamics.TruePeakLimiter(sample_rate, channels, ceiling=-1.0) if use_clipper else None
+
+        # --- Pass 2: Apply & Write ---
+        print(f"Streaming pass 2/2: rendering {output_file}...")
+        now_full = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        writer = open_block_writer(output_file, sample_rate, channels, sample_width, export_format,
+                                   tags={"artist": "Mastered by Python Tool", "date": now_full},
+                                   frames=total_frames, dither=dither, deliverables=deliverables)
+        fade_len = min(int(sample_rate * fade_ms / 1000.0), total_frames)
+        fade_ramp = np.linspace(0.0, 1.0, fade_len, endpoint=False, dtype=np.float32)[:, None]
+        out_analysis = analysis.AnalysisAccumulator(sample_rate, channels)
+        state = {}
+        compressor = _make_compressor(multiband, sample_rate, channels)
+        pos = 0
+
+        def finish(block, clip):
+            # Everything after the loudness limiter; `pos` counts output frames
+            nonlocal pos
+            if clip:
+                block = clip_limiter.process(clipper.process(block))
+
+            # Fades, positioned against the whole render
+            n = len(block)
+            if pos < fade_len:
+                k = min(fade_len - pos, n)
+                block[:k] *= fade_ramp[pos:pos + k]
+            tail_start = total_frames - fade_len
+            if pos + n > tail_start:
+                k = max(tail_start - pos, 0)
+                block[k:] *= fade_ramp[::-1][pos + k - tail_start:pos + n - tail_start]
+
+            out_analysis.add(block)
+            writer.write(block)
+            pos += n
+
+        try:
+            with prof.stage(profiler, "stream_render"):
+                blocks = _blocks(reader, start_frame, start_frame + total_frames, block_frames)
+                equalizer = _make_equalizer(eq_bands, eq_phase, sample_rate, channels)
+                for block in _filter_stages(blocks, sample_rate, state, hp_cutoff, lp_cutoff, stereo_width,
+                                            compressor, equalizer):
+                    block *= np.float32(gain)
+                    finish(limiter.process(block), use_clipper)
+                finish(limiter.flush(), use_clipper)
+                if use_clipper:
+                    # Drain the clipper into its limiter, then the limiter, without clipping again
+                    finish(clip_limiter.process(clipper.flush()), False)
+                    finish(clip_limiter.flush(), False)
+        finally:
+            writer.close()
+    finally:
+        reader.close()
+
+    report = out_analysis.report()
+    engine.report_analysis(report)
+
+    # Every output was hashed while it was written
+    records = writer.records()
+    sig = records[0]["sha256"]
+    manifest = None
+    if deliverables:
+        import export
+        manifest = export.write_manifest(output_file, records, report=report,
+                                         source={"input_file": input_file, "start_sec": start_sec, "end_sec": end_sec})
+    now_short = datetime.datetime.now().strftime("%H:%M:%S")
+    print(f"[{now_short}] Done: {output_file}")
+    print(f"[{now_short}] SHA-256 Signature: {sig}")
+
+    return {
+        "output_file": output_file,
+        "sha256": sig,
+        "duration_sec": total_frames / sample_rate,
+        "lufs": report["integrated_lufs"],
+        "analysis": report,
+        "deliverables": records,
+        "manifest": manifest,
+    }
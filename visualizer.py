@@ -7,10 +7,30 @@ import numpy as np
 from librosa.display import specshow
 
 
+def analysis_image_path(mastered_path):
+    return mastered_path.rsplit(".", 1)[0] + "_analysis.png"
+
+
+def _load_mono(path, sr=None):
+    # PCM WAV comes straight off a memory map; anything else (or a resample) goes through librosa
+    import wavio
+
+    if wavio.is_wav(path):
+        try:
+            wav = wavio.WavFile(path)
+        except wavio.WavFormatError:
+            wav = None
+        if wav is not None and sr in (None, wav.sample_rate):
+            y = wav.read().mean(axis=1)
+            wav.close()
+            return y, wav.sample_rate
+    return librosa.load(path, sr=sr)
+
+
 def visualize_mastering(original_path, mastered_path):
-    #Load audio (default 22050Hz for analysis)
-    y_orig, sr = librosa.load(original_path, sr=None)
-    y_mast, _ = librosa.load(mastered_path, sr=sr)
+    #Load audio at the native rate
+    y_orig, sr = _load_mono(original_path)
+    y_mast, _ = _load_mono(mastered_path, sr=sr)
 
     plt.style.use('dark_background')
     fig, axes = plt.subplots(2, 2, figsize=(14, 10), sharex='col', sharey='row')
@@ -37,11 +57,119 @@ def visualize_mastering(original_path, mastered_path):
     # Add a global colorbar to show decibel intensity
     fig.colorbar(img2, ax=axes[1, :], format="%+2.0f dB")
 
-    image_filename = mastered_path.rsplit(".", 1)[0] + "_analysis.png"
+    image_filename = analysis_image_path(mastered_path)
     plt.savefig(image_filename, bbox_inches='tight', dpi=100)
     plt.clf()
     plt.close('all')
 
     import gc
     gc.collect()
-    print(f"Visual analysis saved as: {image_filename}")
\ No newline at end of file
+    print(f"Visual analysis saved as: {image_filename}")
+    return image_filename
+
+# --- Fast Preview ---
+# Works from the in-memory buffers instead of re-reading both files: a min/max
+# waveform envelope and a decimated STFT with one column per pixel, drawn with
+# the object-oriented matplotlib API so it can also run on a background thread.
+
+PREVIEW_WIDTH_PX = 700 # one panel of the 14in figure at dpi=100
+PREVIEW_FFT = 2048
+PREVIEW_FREQ_BINS = 256
+PREVIEW_TOP_DB = 80.0
+
+_preview_executor = None
+
+
+def preview_data(buffer, sample_rate, width_px=PREVIEW_WIDTH_PX):
+    """Reduces a (frames, channels) buffer to what the preview actually draws."""
+    mono = buffer.mean(axis=1) if buffer.ndim == 2 else buffer
+    n = len(mono)
+    freqs = np.geomspace(20.0, sample_rate / 2.0, PREVIEW_FREQ_BINS)
+    if not n:
+        # Nothing to draw; render_preview leaves the panels blank
+        return {
+            "duration": 0.0,
+            "env_min": np.zeros(0, dtype=mono.dtype),
+            "env_max": np.zeros(0, dtype=mono.dtype),
+            "spectrum": np.zeros((PREVIEW_FREQ_BINS, 0), dtype=np.float32),
+            "freqs": freqs,
+        }
+    cols = max(1, min(width_px, n))
+
+    # --- Waveform envelope: min/max per pixel column ---
+    edges = np.linspace(0, n, cols + 1).astype(int)[:-1]
+    env_min = np.minimum.reduceat(mono, edges)
+    env_max = np.maximum.reduceat(mono, edges)
+
+    # --- Decimated STFT: one windowed frame per pixel column ---
+    n_fft = min(PREVIEW_FFT, n)
+    starts = np.linspace(0, n - n_fft, cols).astype(int)
+    frames = mono[starts[:, None] + np.arange(n_fft)] * np.hanning(n_fft).astype(np.float32)
+    magnitude = np.abs(np.fft.rfft(frames, axis=1))
+
+    # Pick the STFT bin nearest to each log-spaced display row
+    fft_freqs = np.fft.rfftfreq(n_fft, 1.0 / sample_rate)
+    rows = np.clip(np.searchsorted(fft_freqs, freqs), 0, len(fft_freqs) - 1)
+    spectrum = 20 * np.log10(magnitude[:, rows].T + 1e-10)
+    spectrum -= spectrum.max()
+    np.maximum(spectrum, -PREVIEW_TOP_DB, out=spectrum)
+
+    return {
+        "duration": n / sample_rate,
+        "env_min": env_min,
+        "env_max": env_max,
+        "spectrum": spectrum.astype(np.float32),
+        "freqs": freqs,
+    }
+
+
+def render_preview(original, mastered, image_filename):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(14, 10), facecolor="black")
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(2, 2, sharex='col', sharey='row')
+    fig.suptitle("Mastering Comparison: Original vs. Processed", fontsize=16, color="white")
+
+    panels = ((original, "Original", '#458588'), (mastered, "Mastered", '#d79921'))
+    img = None
+    for col, (data, name, color) in enumerate(panels):
+        times = np.linspace(0, data["duration"], len(data["env_min"]))
+
+        # --- ROW 1: WAVEFORMS (Amplitude) ---
+        axes[0, col].fill_between(times, data["env_min"], data["env_max"], color=color, alpha=0.8, linewidth=0)
+        axes[0, col].set_title(f"{name} Waveform", color="white")
+
+        # --- ROW 2 : SPECTOGRAMS (Frequencies) ---
+        if data["spectrum"].size:
+            img = axes[1, col].imshow(data["spectrum"], origin="lower", aspect="auto", cmap="magma",
+                                      extent=(0, data["duration"], 0, len(data["freqs"])))
+        axes[1, col].set_title(f"{name} Spectrum", color="white")
+        axes[1, col].set_xlabel("Time", color="white")
+
+    # Log-frequency rows, label them in Hz
+    freqs = original["freqs"]
+    ticks = [f for f in (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384) if freqs[0] <= f <= freqs[-1]]
+    axes[1, 0].set_yticks(np.interp(np.log(ticks), np.log(freqs), np.arange(len(freqs))))
+    axes[1, 0].set_yticklabels([f"{t // 1000}k" if t >= 1000 else str(t) for t in ticks])
+    axes[1, 0].set_ylabel("Hz", color="white")
+
+    for ax in axes.flat:
+        ax.set_facecolor("black")
+        ax.tick_params(colors="white")
+    if img is not None:
+        fig.colorbar(img, ax=axes[1, :], format="%+2.0f dB")
+
+    fig.savefig(image_filename, bbox_inches='tight', dpi=100, facecolor="black")
+    print(f"Visual analysis saved as: {image_filename}")
+    return image_filename
+
+
+def render_preview_async(original, mastered, image_filename):
+    """Renders on a single background worker and returns a Future for the file name."""
+    global _preview_executor
+    if _preview_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _preview_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="visualizer")
+    return _preview_executor.submit(render_preview, original, mastered, image_filename)
@@ -0,0 +1,240 @@
+import io
+import os
+import struct
+import numpy as np
+
+import engine
+
+# Native PCM WAV I/O. Reading memory-maps the data chunk, so a region of a large
+# file is converted to float32 straight from the page cache without decoding
+# the rest of the file or copying it through pydub. Writing goes through one
+# large buffered file with an exact header, so the bytes land on disk in a
+# single sequential pass. Compressed formats still go through pydub/ffmpeg.
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+CONVERT_BLOCK_FRAMES = 262144
+WRITE_BUFFER_BYTES = 1 << 20
+
+# RIFF INFO ids for the tags snip_audio writes
+INFO_TAGS = {"title": b"INAM", "artist": b"IART", "date": b"ICRD", "comment": b"ICMT", "software": b"ISFT"}
+
+
+class WavFormatError(ValueError):
+    pass
+
+
+def is_wav(path):
+    """True for files that carry a RIFF/WAVE header, whatever the extension."""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(12)
+    except OSError:
+        return False
+    return len(header) == 12 and header[:4] == b"RIFF" and header[8:12] == b"WAVE"
+
+
+# --- Reader ---
+class WavFile:
+    """
+    A memory-mapped PCM WAV file: 8/16/24/32-bit integer or 32/64-bit float,
+    plain or WAVE_FORMAT_EXTENSIBLE. `samples` is a (frames, channels) view of
+    the file (24-bit is (frames, channels, 3) bytes); read() returns float32.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fmt, data_offset, data_size = self._parse(path)
+        format_tag, self.channels, self.sample_rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+        if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+            # The real format is in the first two bytes of the SubFormat GUID
+            format_tag = struct.unpack("<H", fmt[24:26])[0]
+        if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+            raise WavFormatError(f"{path}: unsupported WAV format tag {format_tag:#06x}")
+
+        self.is_float = format_tag == WAVE_FORMAT_IEEE_FLOAT
+        self.sample_width = block_align // self.channels
+        if self.is_float and self.sample_width not in (4, 8):
+            raise WavFormatError(f"{path}: unsupported float width {bits} bits")
+        if not self.is_float and self.sample_width not in (1, 2, 3, 4):
+            raise WavFormatError(f"{path}: unsupported PCM width {bits} bits")
+
+        # Streamed writers leave 0 or 0xFFFFFFFF in the size field; trust the file length
+        available = os.path.getsize(path) - data_offset
+        if data_size == 0 or data_size > available:
+            data_size = available
+        self.frames = data_size // block_align
+
+        if self.sample_width == 3:
+            dtype, shape = np.uint8, (self.frames, self.channels, 3)
+        elif self.is_float:
+            dtype, shape = (np.float32 if self.sample_width == 4 else np.float64), (self.frames, self.channels)
+        else:
+            dtype, shape = (np.uint8 if self.sample_width == 1 else engine.INT_TYPES[self.sample_width]), (self.frames, self.channels)
+        if self.frames:
+            self.samples = np.memmap(path, dtype=np.dtype(dtype).newbyteorder("<"), mode="r",
+                                     offset=data_offset, shape=shape)
+        else:
+            self.samples = np.zeros(shape, dtype=dtype)
+
+    @staticmethod
+    def _parse(path):
+        with open(path, "rb") as f:
+            riff = f.read(12)
+            if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+                raise WavFormatError(f"{path}: not a RIFF/WAVE file")
+            fmt = None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    raise WavFormatError(f"{path}: no data chunk")
+                chunk_id, size = struct.unpack("<4sI", header)
+                if chunk_id == b"fmt ":
+                    fmt = f.read(size)
+                    if size % 2:
+                        f.seek(1, io.SEEK_CUR)
+                elif chunk_id == b"data":
+                    if fmt is None:
+                        raise WavFormatError(f"{path}: data chunk before fmt chunk")
+                    return fmt, f.tell(), size
+                else:
+                    # Chunks are padded to an even length
+                    f.seek(size + size % 2, io.SEEK_CUR)
+
+    @property
+    def duration_sec(self):
+        return self.frames / self.sample_rate
+
+    @property
+    def export_width(self):
+        """Integer sample width for a master made from this file (float input goes to 32-bit)."""
+        return 4 if self.is_float else self.sample_width
+
+    def read(self, start=0, end=None):
+        """Converts frames [start, end) to a new float32 (frames, channels) buffer in -1.0..1.0."""
+        end = self.frames if end is None else min(end, self.frames)
+        start = max(0, min(start, end))
+        out = np.empty((end - start, self.channels), dtype=np.float32)
+        # Block-wise, so only one small integer temporary is alive at a time
+        for pos in range(start, end, CONVERT_BLOCK_FRAMES):
+            stop = min(pos + CONVERT_BLOCK_FRAMES, end)
+            self._convert(self.samples[pos:stop], out[pos - start:stop - start])
+        return out
+
+    def _convert(self, raw, out):
+        if self.is_float:
+            out[:] = raw
+        elif self.sample_width == 3:
+            # 24-bit: pad each sample to 32-bit, low byte zero
+            wide = np.zeros(raw.shape[:2] + (4,), dtype=np.uint8)
+            wide[..., 1:] = raw
+            np.multiply(wide.view("<i4")[..., 0], np.float32(1.0 / engine.full_scale(4)), out=out)
+        elif self.sample_width == 1:
+            # 8-bit WAV is unsigned
+            np.subtract(raw, np.float32(128.0), out=out)
+            out *= np.float32(1.0 / 128.0)
+        else:
+            np.multiply(raw, np.float32(1.0 / engine.full_scale(self.sample_width)), out=out)
+
+    def close(self):
+        # Dropping the memmap releases the mapping
+        self.samples = None
+
+
+# --- Writer ---
+def _info_chunk(tags):
+    body = b""
+    for key, value in (tags or {}).items():
+        tag_id = INFO_TAGS.get(key)
+        if tag_id is None:
+            continue
+        text = str(value).encode("utf-8") + b"\x00"
+        if len(text) % 2:
+            text += b"\x00"
+        body += struct.pack("<4sI", tag_id, len(text)) + text
+    if not body:
+        return b""
+    return struct.pack("<4sI", b"LIST", len(body) + 4) + b"INFO" + body
+
+
+def _header(sample_rate, channels, sample_width, frames, tags=None):
+    block_align = channels * sample_width
+    data_size = frames * block_align
+    fmt = struct.pack("<HHIIHH", WAVE_FORMAT_PCM, channels, sample_rate,
+                      sample_rate * block_align, block_align, sample_width * 8)
+    info = _info_chunk(tags)
+    riff_size = 4 + (8 + len(fmt)) + len(info) + 8 + data_size + data_size % 2
+    return (struct.pack("<4sI4s", b"RIFF", riff_size, b"WAVE")
+            + struct.pack("<4sI", b"fmt ", len(fmt)) + fmt
+            + info
+            + struct.pack("<4sI", b"data", data_size))
+
+
+def encode_pcm(block, sample_width, dither=None):
+    """Quantizes a float32 block to little-endian PCM bytes (8/16/24/32-bit), dithered if given an engine.Dither."""
+    pcm = engine.quantize(block, sample_width, dither)
+    if sample_width == 3:
+        # Shift the 24-bit values into the top of the int32 and keep its upper three bytes
+        pcm <<= 8
+        return pcm.astype("<i4", copy=False).view(np.uint8).reshape(-1, 4)[:, 1:].tobytes()
+    if sample_width == 1:
+        # 8-bit WAV is unsigned
+        return (pcm.astype(np.int16) + 128).astype(np.uint8).tobytes()
+    return pcm.astype(f"<i{sample_width}", copy=False).tobytes()
+
+
+class WavWriter:
+    """
+    Buffered integer PCM WAV writer. With `frames` known up front the header
+    is final before any audio is written (so the byte stream can be hashed as
+    it goes); otherwise the size fields are patched on close. `dither` is an
+    engine.Dither that carries its state across write() calls.
+    """
+
+    def __init__(self, path, sample_rate, channels, sample_width=2, frames=None, tags=None, dither=None):
+        self.path = path
+        self.dither = dither
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frames = frames
+        self.tags = tags
+        self.written = 0
+        self._file = open(path, "wb", buffering=WRITE_BUFFER_BYTES)
+        self._header_len = 0
+        self._emit(_header(sample_rate, channels, sample_width, frames or 0, tags))
+        self._header_len = self._file.tell()
+
+    def _emit(self, data):
+        self._file.write(data)
+
+    def write(self, block):
+        self._emit(encode_pcm(block, self.sample_width, self.dither))
+        self.written += len(block)
+
+    def close(self):
+        if self._file is None:
+            return
+        data_size = self.written * self.channels * self.sample_width
+        if data_size % 2:
+            self._emit(b"\x00")
+        if self.frames != self.written:
+            # Patch the RIFF and data sizes now that the length is known
+            header = _header(self.sample_rate, self.channels, self.sample_width, self.written, self.tags)
+            self._file.seek(0)
+            self._file.write(header)
+        self._file.close()
+        self._file = None
+
+
+def write_wav(path, buffer, sample_rate, sample_width=2, tags=None, dither=None):
+    """Writes a whole float32 (frames, channels) buffer as PCM WAV, block by block."""
+    writer = WavWriter(path, sample_rate, buffer.shape[1], sample_width, frames=len(buffer), tags=tags, dither=dither)
+    try:
+        for pos in range(0, len(buffer), CONVERT_BLOCK_FRAMES):
+            writer.write(buffer[pos:pos + CONVERT_BLOCK_FRAMES])
+    finally:
+        writer.close()
+    return path